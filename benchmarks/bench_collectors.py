@@ -0,0 +1,94 @@
+"""Failover benchmark of several collectors posting to one aggregator.
+
+Starts an aggregator and several collector processes polling the same
+simulated devices on localhost, stops the collector the devices are read
+from half way and reports, for each device, the readings accepted and
+dropped as duplicates, the failovers and the longest gap between accepted
+readings, run from the repository root with:
+
+    python benchmarks/bench_collectors.py
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from custom_components.airthings_wave.aggregator import Aggregator  # noqa: E402
+
+
+async def start_collector(name, port, args, directory):
+    config = {"simulate": args.devices, "scan_interval": args.scan_interval,
+              "sinks": [{"type": "http", "url": "http://127.0.0.1:{}/readings".format(port),
+                         "collector": name, "flush_interval": 0.2}]}
+    path = os.path.join(directory, "{}.json".format(name))
+    with open(path, "w", encoding="utf-8") as config_file:
+        json.dump(config, config_file)
+    return await asyncio.create_subprocess_exec(
+        sys.executable, "-m", "custom_components.airthings_wave.daemon", "--config", path,
+        cwd=ROOT, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+
+
+async def stop_collector(process):
+    if process.returncode is None:
+        process.send_signal(signal.SIGINT)
+        await process.wait()
+
+
+async def run(args):
+    accepted = {}
+
+    def reading_accepted(mac, reading):
+        accepted.setdefault(mac, []).append(time.monotonic())
+
+    aggregator = Aggregator("127.0.0.1", 0, failover_time=args.failover_time)
+    await aggregator.start(reading_accepted)
+    with tempfile.TemporaryDirectory() as directory:
+        collectors = {}
+        for i in range(args.collectors):
+            name = "collector-{}".format(i)
+            collectors[name] = await start_collector(name, aggregator.port, args, directory)
+        try:
+            await asyncio.sleep(args.duration / 2.0)
+            owners = list(aggregator.owners.values())
+            stopped = max(set(owners), key=owners.count) if owners else "collector-0"
+            print("Stopping {} after {:.0f}s".format(stopped, args.duration / 2.0))
+            await stop_collector(collectors[stopped])
+            await asyncio.sleep(args.duration / 2.0)
+        finally:
+            for process in collectors.values():
+                await stop_collector(process)
+    await aggregator.stop()
+
+    print("{:<18} {:<12} {:>8} {:>10} {:>9} {:>10}".format(
+        "device", "collector", "accepted", "duplicate", "failover", "max gap s"))
+    for mac in sorted(aggregator.owners):
+        metrics = aggregator.metrics.device(mac)
+        times = accepted.get(mac, [])
+        gap = max((b - a for a, b in zip(times, times[1:])), default=0.0)
+        print("{:<18} {:<12} {:>8} {:>10} {:>9} {:>10.1f}".format(
+            mac, aggregator.owners[mac], metrics.polls, metrics.duplicates, metrics.failovers, gap))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--collectors", type=int, default=3)
+    parser.add_argument("--devices", type=int, default=4, help="simulated devices seen by every collector")
+    parser.add_argument("--scan-interval", type=int, default=2)
+    parser.add_argument("--failover-time", type=float, default=6.0)
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds to run")
+    parser.add_argument("--verbose", action="store_true", help="show the log of the aggregator")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
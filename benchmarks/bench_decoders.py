@@ -0,0 +1,60 @@
+"""Micro-benchmark of the characteristic decoders.
+
+Decodes payloads recorded from each Airthings model and reports the time per
+decoded device reading, run from the repository root with:
+
+    python benchmarks/bench_decoders.py
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from custom_components.airthings_wave.decoders import (  # noqa: E402
+    CHAR_UUID_DATETIME, CHAR_UUID_TEMPERATURE, CHAR_UUID_HUMIDITY,
+    CHAR_UUID_RADON_1DAYAVG, CHAR_UUID_RADON_LONG_TERM_AVG,
+    CHAR_UUID_ILLUMINANCE_ACCELEROMETER, CHAR_UUID_WAVE_PLUS_DATA,
+    CHAR_UUID_WAVE_2_DATA, CHAR_UUID_WAVEMINI_DATA, COMMAND_UUID,
+    find_decoder, Reading)
+
+# Raw characteristic values of one reading of each model
+RECORDED_PAYLOADS = {
+    "wave": [(CHAR_UUID_DATETIME, "e50705010c1e00"),
+             (CHAR_UUID_TEMPERATURE, "6608"),
+             (CHAR_UUID_HUMIDITY, "9411"),
+             (CHAR_UUID_RADON_1DAYAVG, "3200"),
+             (CHAR_UUID_RADON_LONG_TERM_AVG, "3d00"),
+             (CHAR_UUID_ILLUMINANCE_ACCELEROMETER, "0c03")],
+    "wave_2": [(CHAR_UUID_WAVE_2_DATA, "015800002f003a00270800000000000000000000")],
+    "wave_plus": [(CHAR_UUID_WAVE_PLUS_DATA, "015a000034003d00690825c42c03860000000000"),
+                  (COMMAND_UUID, "6d0040e201000000190000000000000000000000000000000000860b0000")],
+    "wave_mini": [(CHAR_UUID_WAVEMINI_DATA, "01001c73c9c3a011620000000000000000000000"),
+                  (COMMAND_UUID, "6d0040e201000000190000000000000000000000000000000000860b0000")],
+}
+
+
+def decode_reading(payloads):
+    reading = Reading()
+    for decoder, raw_data in payloads:
+        decoder.decode_into(reading, raw_data)
+    return reading
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--number", type=int, default=20000, help="decodes per measurement")
+    parser.add_argument("--repeat", type=int, default=5, help="measurements per model")
+    args = parser.parse_args()
+
+    for model, recorded in RECORDED_PAYLOADS.items():
+        payloads = [(find_decoder(uuid), bytearray.fromhex(raw)) for uuid, raw in recorded]
+        readings = decode_reading(payloads)
+        best = min(timeit.repeat(lambda: decode_reading(payloads), number=args.number, repeat=args.repeat))
+        print("{:<10} {:>8.2f} us/reading  {} values".format(
+            model, best / args.number * 1e6, len(readings)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""End-to-end polling benchmark against simulated Airthings devices.
+
+Sets up and polls 1, 10 and 100 simulated devices through AirthingsWaveDetect
+and reports the poll cycle time, the per-device connection time percentiles
+and the memory used, optionally spread over several adapters with
+--adapters, run from the repository root with:
+
+    python benchmarks/bench_polling.py
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from custom_components.airthings_wave.airthings import AirthingsWaveDetect  # noqa: E402
+from custom_components.airthings_wave.simulator import SimulatedTransport  # noqa: E402
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))]
+
+
+async def run(num_devices, args):
+    adapters = ["hci{}".format(i) for i in range(args.adapters)]
+    transport = SimulatedTransport(connect_latency=args.connect_latency, read_latency=args.read_latency,
+                                   failure_rate=args.failure_rate, notification_delay=args.notification_delay,
+                                   seed=args.seed, adapters=adapters, adapter_slots=args.adapter_slots,
+                                   concurrent_reads=args.concurrent_reads)
+    transport.add_devices(num_devices)
+    detect = AirthingsWaveDetect(0, max_connections=args.max_connections, transport=transport,
+                                 adapters=adapters, pipelined_reads=not args.sequential)
+    detect.airthing_devices = list(transport.devices)
+
+    tracemalloc.start()
+    start = time.monotonic()
+    await detect.setup_devices()
+    setup_time = time.monotonic() - start
+    transport.sessions = {}
+
+    cycle_times = []
+    for _cycle in range(args.cycles):
+        start = time.monotonic()
+        await detect.get_sensor_data()
+        cycle_times.append(time.monotonic() - start)
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = [duration for durations in transport.sessions.values() for duration in durations]
+    print("{:>7} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>9.1f} {:>6}/{}".format(
+        num_devices, setup_time, sum(cycle_times) / len(cycle_times),
+        percentile(latencies, 50), percentile(latencies, 90), percentile(latencies, 99),
+        peak / 1024.0, len(detect.sensordata), num_devices))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, nargs="+", default=[1, 10, 100])
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--max-connections", type=int, default=5)
+    parser.add_argument("--connect-latency", type=float, default=0.05)
+    parser.add_argument("--read-latency", type=float, default=0.01)
+    parser.add_argument("--notification-delay", type=float, default=0.02)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--adapters", type=int, default=1, help="number of simulated Bluetooth adapters")
+    parser.add_argument("--adapter-slots", type=int, help="connections each adapter accepts at a time")
+    parser.add_argument("--concurrent-reads", choices=["overlap", "serialize", "reject"], default="overlap",
+                        help="how the simulated devices handle pipelined reads")
+    parser.add_argument("--sequential", action="store_true", help="read the characteristics one at a time")
+    parser.add_argument("--verbose", action="store_true", help="show the log of the integration")
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    print("{:>7} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9} {:>8}".format(
+        "devices", "setup s", "cycle s", "p50 s", "p90 s", "p99 s", "peak KiB", "read"))
+    for num_devices in args.devices:
+        asyncio.run(run(num_devices, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""Replays captured Bluetooth traffic through the decoders.
+
+Polls the devices of a capture file, recorded with the capture_file option,
+through AirthingsWaveDetect and reports the decode and poll time per device
+together with the decoded values of the first poll, to profile and check the
+parsing of real traffic without radios. Run from the repository root with:
+
+    python benchmarks/bench_replay.py airthings.capture
+
+Without a capture file, one is first recorded from simulated devices.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from custom_components.airthings_wave.airthings import AirthingsWaveDetect  # noqa: E402
+from custom_components.airthings_wave.capture import ReplayTransport  # noqa: E402
+from custom_components.airthings_wave.simulator import SimulatedTransport  # noqa: E402
+
+
+async def record(path, num_devices, cycles):
+    transport = SimulatedTransport(connect_latency=0.02, read_latency=0.005, notification_delay=0.01, seed=1)
+    transport.add_devices(num_devices)
+    detect = AirthingsWaveDetect(0, max_connections=4, transport=transport, capture=path)
+    detect.airthing_devices = list(transport.devices)
+    await detect.setup_devices()
+    for _cycle in range(cycles):
+        detect.last_scan = -1
+        await detect.get_sensor_data()
+    await detect.close()
+
+
+async def replay(path, args):
+    transport = ReplayTransport(path, speed=args.speed)
+    detect = AirthingsWaveDetect(0, max_connections=args.max_connections, transport=transport)
+    detect.airthing_devices = sorted(transport.devices)
+    await detect.setup_devices()
+    for mac in sorted(detect.sensordata):
+        print("{} {}".format(mac, detect.sensordata[mac]))
+    for _cycle in range(args.cycles):
+        detect.last_scan = -1
+        await detect.get_sensor_data()
+
+    print()
+    print("{:<18} {:>6} {:>8} {:>12} {:>12}".format("device", "polls", "failed", "decode us", "poll ms"))
+    for mac, metrics in sorted(detect.metrics.devices.items()):
+        print("{:<18} {:>6} {:>8} {:>12.2f} {:>12.3f}".format(
+            mac, metrics.polls, metrics.poll_failures, (metrics.decode_time.mean or 0) * 1e6,
+            (metrics.poll_time.mean or 0) * 1e3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("capture", nargs="?", help="capture file, recorded from simulated devices if omitted")
+    parser.add_argument("--cycles", type=int, default=100)
+    parser.add_argument("--speed", type=float, default=0, help="replay speed, 1 for real time, 0 for no delays")
+    parser.add_argument("--max-connections", type=int, default=4)
+    parser.add_argument("--devices", type=int, default=4, help="simulated devices to record")
+    parser.add_argument("--verbose", action="store_true", help="show the log of the integration")
+    args = parser.parse_args()
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+
+    path = args.capture
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), "simulated.capture")
+        asyncio.run(record(path, args.devices, 5))
+        print("Recorded {} ({} bytes)".format(path, os.path.getsize(path)))
+    asyncio.run(replay(path, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""Check and benchmark of the MQTT and Prometheus sinks of the collector daemon.
+
+Submits readings of simulated devices to an MqttSink publishing to a local
+SimulatedMqttBroker and to a PrometheusSink scraped over HTTP, checks that
+the latest reading of every device arrives and reports the time to deliver
+them. Also checks that readings are dropped, not queued without bound, when
+a sink falls behind or its broker is down. Exits with an error when a check
+fails, run from the repository root with:
+
+    python benchmarks/bench_sinks.py
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from custom_components.airthings_wave.exporters import MqttSink, PrometheusSink  # noqa: E402
+from custom_components.airthings_wave.simulator import SimulatedMqttBroker  # noqa: E402
+
+
+def readings(args):
+    # (mac, timestamp, data) of every device for every round
+    for i in range(args.rounds):
+        for device in range(args.devices):
+            mac = "A4:DA:22:00:{:02X}:{:02X}".format(device // 256, device % 256)
+            yield mac, 1600000000.0 + i, {"temperature": 20.0 + i / 100.0, "humidity": 40.0 + device % 10}
+
+
+def latest(args):
+    return {mac: (timestamp, data) for mac, timestamp, data in readings(args)}
+
+
+def topic(mac):
+    return "bench/{}".format(mac.replace(":", "").lower())
+
+
+def check(condition, message):
+    if not condition:
+        raise SystemExit("FAILED: {}".format(message))
+
+
+async def submit_all(sink, args):
+    # Submit in rounds, giving the sink task a chance to run like the polls do
+    count = 0
+    for mac, timestamp, data in readings(args):
+        sink.submit(mac, data, timestamp)
+        count += 1
+        if count % args.devices == 0:
+            await asyncio.sleep(0)
+    return count
+
+
+async def bench_mqtt(args):
+    broker = SimulatedMqttBroker()
+    await broker.start()
+    sink = MqttSink("127.0.0.1", broker.port, topic="bench", retain=True, client_id="bench_sinks",
+                    flush_interval=0.05, max_queue=args.devices * args.rounds)
+    await sink.start()
+    start = time.monotonic()
+    submitted = await submit_all(sink, args)
+    await sink.stop()
+    # The broker reads what the client wrote before disconnecting
+    expected = latest(args)
+    deadline = time.monotonic() + 5
+    while time.monotonic() < deadline and any(
+            json.loads(broker.retained.get(topic(mac), "{}")).get("timestamp") != timestamp
+            for mac, (timestamp, _data) in expected.items()):
+        await asyncio.sleep(0.01)
+    elapsed = time.monotonic() - start
+    await broker.stop()
+
+    check(broker.clients == ["bench_sinks"], "expected one MQTT client, got {}".format(broker.clients))
+    check(len(broker.retained) == len(expected),
+          "expected {} retained topics, got {}".format(len(expected), len(broker.retained)))
+    for mac, (timestamp, data) in expected.items():
+        payload = broker.retained.get(topic(mac))
+        check(payload is not None, "no message of {}".format(mac))
+        message = json.loads(payload)
+        check(message["mac"] == mac and message["timestamp"] == timestamp and
+              message["temperature"] == data["temperature"],
+              "stale message of {}: {}".format(mac, message))
+    check(sink.dropped == 0, "{} reading(s) dropped".format(sink.dropped))
+    return "mqtt", submitted, len(broker.messages), sink.dropped, elapsed
+
+
+async def scrape(port, path="/metrics"):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write("GET {} HTTP/1.1\r\nHost: localhost\r\n\r\n".format(path).encode("latin-1"))
+    response = await reader.read()
+    writer.close()
+    head, _, body = response.decode("utf-8").partition("\r\n\r\n")
+    return head.split()[1], body
+
+
+async def bench_prometheus(args):
+    sink = PrometheusSink("127.0.0.1", 0, flush_interval=0.05, max_queue=args.devices * args.rounds)
+    await sink.start()
+    start = time.monotonic()
+    submitted = await submit_all(sink, args)
+    # Let the sink task take the queued readings before scraping
+    while not sink._queue.empty():
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.1)
+    status, body = await scrape(sink.port)
+    elapsed = time.monotonic() - start
+    not_found, _ = await scrape(sink.port, "/other")
+    await sink.stop()
+
+    check(status == "200", "scrape returned {}".format(status))
+    check(not_found == "404", "unknown path returned {}".format(not_found))
+    lines = set(body.splitlines())
+    check("# TYPE airthings_temperature gauge" in lines, "no temperature gauge")
+    for mac, (timestamp, data) in latest(args).items():
+        for line in ('airthings_temperature{{mac="{}"}} {}'.format(mac, data["temperature"]),
+                     'airthings_last_update_timestamp_seconds{{mac="{}"}} {}'.format(mac, timestamp)):
+            check(line in lines, "missing {}".format(line))
+    return "prometheus", submitted, len(sink.latest), sink.dropped, elapsed
+
+
+async def bench_overflow(args):
+    # Nothing is read from the queue until the loop runs, the oldest
+    # readings beyond max_queue are dropped.
+    sink = PrometheusSink("127.0.0.1", 0, flush_interval=0.05, max_queue=args.devices)
+    await sink.start()
+    start = time.monotonic()
+    submitted = 0
+    for mac, timestamp, data in readings(args):
+        sink.submit(mac, data, timestamp)
+        submitted += 1
+    await sink.stop()
+    elapsed = time.monotonic() - start
+    check(sink.dropped == submitted - args.devices,
+          "expected {} dropped, got {}".format(submitted - args.devices, sink.dropped))
+    check(all(sink.latest[mac][0] == timestamp for mac, (timestamp, _data) in latest(args).items()),
+          "the latest readings were dropped instead of the oldest")
+    return "overflow", submitted, len(sink.latest), sink.dropped, elapsed
+
+
+async def bench_broker_down(args):
+    # A port nothing listens on, the batches are dropped with a warning
+    broker = SimulatedMqttBroker()
+    await broker.start()
+    port = broker.port
+    await broker.stop()
+    sink = MqttSink("127.0.0.1", port, flush_interval=0.05)
+    await sink.start()
+    start = time.monotonic()
+    submitted = await submit_all(sink, args)
+    await sink.stop()
+    elapsed = time.monotonic() - start
+    check(not sink.client.is_connected, "connected to a stopped broker")
+    return "broker down", submitted, 0, sink.dropped, elapsed
+
+
+async def run(args):
+    print("{:<12} {:>9} {:>10} {:>8} {:>9}".format("sink", "submitted", "delivered", "dropped", "time s"))
+    for bench in (bench_mqtt, bench_prometheus, bench_overflow, bench_broker_down):
+        print("{:<12} {:>9} {:>10} {:>8} {:>9.3f}".format(*await bench(args)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=10, help="readings submitted per device")
+    parser.add_argument("--verbose", action="store_true", help="show the log of the sinks")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.CRITICAL)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
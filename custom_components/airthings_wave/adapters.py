@@ -0,0 +1,137 @@
+"""Sharding of the devices over the Bluetooth adapters."""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# RSSI assumed for a device not seen by an adapter
+UNSEEN_RSSI = -110
+
+
+class Adapter:
+    # A Bluetooth controller with its own connection slots and health, name
+    # is the adapter passed to bleak (hci0, ...), None for the default one.
+    def __init__(self, name, max_connections):
+        self.name = name
+        self.max_connections = max_connections
+        self.devices = set()
+        # Moving average of the connection failures, 0 is healthy
+        self.failure_rate = 0.0
+        self.attempts = 0
+        self.degraded_until = 0.0
+        self._slots = None
+
+    @property
+    def degraded(self):
+        return time.monotonic() < self.degraded_until
+
+    @property
+    def load(self):
+        return len(self.devices) / self.max_connections
+
+    def slot(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_connections)
+        return self._slots
+
+
+class AdapterPool:
+    # Assigns every device to the adapter with the best signal, penalised by
+    # load_weight dB per device per connection slot already on the adapter.
+    # An adapter whose failure rate reaches degrade_threshold is degraded for
+    # degrade_time seconds and its devices move to the other adapters, a
+    # device failing move_after times in a row moves on its own.
+    def __init__(self, names=None, max_connections=1, load_weight=10.0, degrade_threshold=0.5,
+                 degrade_time=600, min_attempts=5, move_after=3, smoothing=0.2):
+        self.adapters = {name: Adapter(name, max_connections) for name in (names or [None])}
+        self.load_weight = load_weight
+        self.degrade_threshold = degrade_threshold
+        self.degrade_time = degrade_time
+        self.min_attempts = min_attempts
+        self.move_after = move_after
+        self.smoothing = smoothing
+        self._rssi = {}
+        self._assigned = {}
+        self._failures = {}
+
+    @property
+    def names(self):
+        return list(self.adapters)
+
+    def record_rssi(self, mac, name, rssi):
+        if rssi is not None and name in self.adapters:
+            self._rssi.setdefault(mac.upper(), {})[name] = rssi
+
+    def _score(self, mac, adapter):
+        rssi = self._rssi.get(mac, {}).get(adapter.name, UNSEEN_RSSI)
+        return rssi - self.load_weight * adapter.load
+
+    def assign(self, mac, exclude=()):
+        mac = mac.upper()
+        current = self._assigned.get(mac)
+        if current is not None:
+            current.devices.discard(mac)
+        candidates = [a for a in self.adapters.values() if a.name not in exclude and not a.degraded]
+        if not candidates:
+            candidates = [a for a in self.adapters.values() if a.name not in exclude] or list(self.adapters.values())
+        adapter = max(candidates, key=lambda a: self._score(mac, a))
+        adapter.devices.add(mac)
+        self._assigned[mac] = adapter
+        self._failures[mac] = 0
+        if current is not None and current is not adapter:
+            _LOGGER.info("Moved %s from adapter %s to %s", mac, current.name, adapter.name)
+        return adapter
+
+    def adapter(self, mac):
+        adapter = self._assigned.get(mac.upper())
+        return self.assign(mac) if adapter is None else adapter
+
+    def record_result(self, mac, success):
+        mac = mac.upper()
+        adapter = self.adapter(mac)
+        adapter.attempts += 1
+        adapter.failure_rate += self.smoothing * ((0.0 if success else 1.0) - adapter.failure_rate)
+        if success:
+            self._failures[mac] = 0
+            return
+        self._failures[mac] = self._failures.get(mac, 0) + 1
+        if len(self.adapters) == 1:
+            return
+        if (adapter.attempts >= self.min_attempts and adapter.failure_rate >= self.degrade_threshold
+                and not adapter.degraded):
+            _LOGGER.warning("Adapter %s degraded, failure rate %.2f, moving its %d device(s)",
+                            adapter.name, adapter.failure_rate, len(adapter.devices))
+            adapter.degraded_until = time.monotonic() + self.degrade_time
+            # Back on probation once the degraded period is over
+            adapter.failure_rate = 0.0
+            adapter.attempts = 0
+            for other in list(adapter.devices):
+                self.assign(other, exclude=(adapter.name,))
+        elif self._failures[mac] >= self.move_after:
+            self.assign(mac, exclude=(adapter.name,))
+
+    def remove(self, mac):
+        adapter = self._assigned.pop(mac.upper(), None)
+        if adapter is not None:
+            adapter.devices.discard(mac.upper())
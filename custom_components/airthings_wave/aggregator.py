@@ -0,0 +1,215 @@
+"""Aggregator of the readings posted by remote collectors.
+
+Collectors are instances of the headless collector (daemon.py) with an http
+sink, each polling the devices in Bluetooth range of its own host. Run a
+standalone aggregator printing the readings it accepts from the directory
+holding custom_components with:
+
+    python -m custom_components.airthings_wave.aggregator --port 8765
+"""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import signal
+import time
+
+from .decoders import Reading
+from .exporters import to_json
+from .metrics import PollMetrics
+
+_LOGGER = logging.getLogger(__name__)
+
+# Largest request body accepted, a batch of 100 readings is about 25 KiB
+MAX_BODY_SIZE = 1024 * 1024
+
+
+class Aggregator:
+    # Receives the readings of remote collectors over HTTP and keeps the
+    # latest reading of each device in sensordata, like AirthingsWaveDetect.
+    # A device is read from one collector at a time: the readings of other
+    # collectors are dropped as duplicates while that collector keeps
+    # delivering, and the device fails over to another collector once the
+    # current one has been silent for failover_time seconds.
+    def __init__(self, host="0.0.0.0", port=8765, failover_time=900, token=None, history=None):
+        self.host = host
+        self.port = port
+        self.failover_time = failover_time
+        self.token = token
+        self.history = history
+        self.metrics = PollMetrics()
+        self.sensordata = {}
+        # No device info, the collectors only send readings
+        self.devices = {}
+        # Collector each device is read from and when it last delivered
+        self.owners = {}
+        self.last_seen = {}
+        self._callback = None
+        self._server = None
+
+    async def start(self, callback=None):
+        # callback(mac, reading) is called for every accepted reading
+        self._callback = callback
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        _LOGGER.info("Accepting readings of collectors on %s:%s", self.host, self.port)
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    def is_fresh(self, mac, now=None):
+        # Whether a collector delivered a reading of the device recently
+        now = time.monotonic() if now is None else now
+        last_seen = self.last_seen.get(mac)
+        return last_seen is not None and now - last_seen < self.failover_time
+
+    def accept(self, collector, mac, reading, now=None):
+        now = time.monotonic() if now is None else now
+        metrics = self.metrics.device(mac)
+        owner = self.owners.get(mac)
+        if owner is not None and owner != collector:
+            if self.is_fresh(mac, now):
+                metrics.duplicates += 1
+                return False
+            _LOGGER.info("No reading of %s from collector %s for %.0fs, failing over to %s",
+                         mac, owner, now - self.last_seen[mac], collector)
+            metrics.failovers += 1
+        else:
+            previous = self.sensordata.get(mac)
+            if previous is not None and reading.timestamp <= previous.timestamp:
+                # Posted again by the collector
+                metrics.duplicates += 1
+                return False
+        self.owners[mac] = collector
+        self.last_seen[mac] = now
+        if self.history is not None:
+            self.history.add(mac, reading.measurements(), reading.timestamp)
+        self.sensordata[mac] = reading
+        metrics.polls += 1
+        metrics.last_success = time.time()
+        if self._callback is not None:
+            self._callback(mac, reading)
+        return True
+
+    def accept_batch(self, content, now=None):
+        # content is the JSON body posted by an HttpSink
+        collector = str(content["collector"])
+        accepted = 0
+        for record in content["readings"]:
+            mac = str(record["mac"]).upper()
+            reading = Reading.from_dict(record, float(record["timestamp"]))
+            if self.accept(collector, mac, reading, now):
+                accepted += 1
+        return accepted
+
+    def status(self, now=None):
+        now = time.monotonic() if now is None else now
+        return {mac: {"collector": self.owners[mac],
+                      "age": round(now - self.last_seen[mac], 1),
+                      "duplicates": self.metrics.device(mac).duplicates,
+                      "failovers": self.metrics.device(mac).failovers}
+                for mac in sorted(self.owners)}
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+            parts = request.decode("latin-1").split()
+            method, path = (parts[0], parts[1].split("?")[0]) if len(parts) >= 2 else ("", "")
+            if self.token is not None and not hmac.compare_digest(
+                    headers.get("authorization", "").encode("utf-8"),
+                    "Bearer {}".format(self.token).encode("utf-8")):
+                status, body = "401 Unauthorized", {"error": "unauthorized"}
+            elif method == "POST" and path == "/readings":
+                length = int(headers.get("content-length", 0))
+                if length > MAX_BODY_SIZE:
+                    status, body = "413 Payload Too Large", {"error": "too large"}
+                else:
+                    content = json.loads(await asyncio.wait_for(reader.readexactly(length), 10))
+                    status, body = "200 OK", {"accepted": self.accept_batch(content)}
+            elif method == "GET" and path in ("/", "/status"):
+                status, body = "200 OK", self.status()
+            else:
+                status, body = "404 Not Found", {"error": "not found"}
+        except (KeyError, TypeError, ValueError) as e:
+            status, body = "400 Bad Request", {"error": repr(e)}
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception:
+            _LOGGER.exception("Failed to handle a request of a collector")
+            status, body = "500 Internal Server Error", {"error": "internal error"}
+        try:
+            content = json.dumps(body).encode("utf-8")
+            writer.write("HTTP/1.1 {}\r\nContent-Type: application/json\r\n"
+                         "Content-Length: {}\r\nConnection: close\r\n\r\n".format(status, len(content)).encode("latin-1"))
+            writer.write(content)
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+async def run(args):
+    if args.token is None:
+        _LOGGER.warning("No --token given, any host that can reach %s:%s can post readings", args.host, args.port)
+    aggregator = Aggregator(args.host, args.port, failover_time=args.failover_time, token=args.token)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    await aggregator.start(lambda mac, reading: print(to_json(mac, reading.timestamp, reading), flush=True))
+    try:
+        await stop.wait()
+    finally:
+        _LOGGER.info("Stopping")
+        await aggregator.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--failover-time", type=float, default=900,
+                        help="seconds without readings from a collector before its devices fail over")
+    parser.add_argument("--token", help="token the collectors must send")
+    parser.add_argument("--verbose", "-v", action="store_true", help="log debug messages")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -18,19 +18,22 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import struct
 import time
 from collections import namedtuple
 
 import logging
-from datetime import datetime
 
-from bleak import BleakClient
-from bleak import BleakScanner
 import asyncio
 
 from uuid import UUID
 
+from .decoders import find_decoder, Reading
+from .adapters import AdapterPool
+from .capture import CaptureTransport
+from .connection import CircuitBreaker, ConnectionPolicy
+from .metrics import PollMetrics
+from .readplan import compile_read_plan
+
 _LOGGER = logging.getLogger(__name__)
 
 # Use full UUID since we do not use UUID from bluetooth library
@@ -41,16 +44,17 @@ CHAR_UUID_DEVICE_NAME = UUID('00002a00-0000-1000-8000-00805f9b34fb')
 CHAR_UUID_FIRMWARE_REV = UUID('00002a26-0000-1000-8000-00805f9b34fb')
 CHAR_UUID_HARDWARE_REV = UUID('00002a27-0000-1000-8000-00805f9b34fb')
 
-CHAR_UUID_DATETIME = UUID('00002a08-0000-1000-8000-00805f9b34fb')
-CHAR_UUID_TEMPERATURE = UUID('00002a6e-0000-1000-8000-00805f9b34fb')
-CHAR_UUID_HUMIDITY = UUID('00002a6f-0000-1000-8000-00805f9b34fb')
-CHAR_UUID_RADON_1DAYAVG = UUID('b42e01aa-ade7-11e4-89d3-123b93f75cba')
-CHAR_UUID_RADON_LONG_TERM_AVG = UUID('b42e0a4c-ade7-11e4-89d3-123b93f75cba')
-CHAR_UUID_ILLUMINANCE_ACCELEROMETER = UUID('b42e1348-ade7-11e4-89d3-123b93f75cba')
-CHAR_UUID_WAVE_PLUS_DATA = UUID('b42e2a68-ade7-11e4-89d3-123b93f75cba')
-CHAR_UUID_WAVE_2_DATA = UUID('b42e4dcc-ade7-11e4-89d3-123b93f75cba')
-CHAR_UUID_WAVEMINI_DATA = UUID('b42e3b98-ade7-11e4-89d3-123b93f75cba')
-COMMAND_UUID = UUID('b42e2d06-ade7-11e4-89d3-123b93f75cba') # "Access Control Point" Characteristic
+# Unexpected disconnects after which a device is no longer kept connected
+# between polls in keep alive mode.
+MAX_KEEP_ALIVE_DROPS = 3
+
+# Polls in a row with failed pipelined reads after which a device is read one
+# characteristic at a time until the next new client.
+MAX_PIPELINE_FAILURES = 3
+
+# Bluetooth SIG company identifier of Airthings, found in the manufacturer data
+# of the advertisements of the devices.
+AIRTHINGS_MANUFACTURER_ID = 820
 
 Characteristic = namedtuple('Characteristic', ['uuid', 'name', 'format'])
 
@@ -71,292 +75,757 @@ class AirthingsDeviceInfo:
         self.firmware_rev = firmware_rev
         self.hardware_rev = hardware_rev
 
+    def as_dict(self):
+        return {characteristic.name: getattr(self, characteristic.name)
+                for characteristic in device_info_characteristics}
+
     def __str__(self):
         return "Manufacturer: {} Model: {} Serial: {} Device: {} Firmware: {} Hardware Rev.: {}".format(
             self.manufacturer, self.model_nr, self.serial_nr, self.device_name, self.firmware_rev, self.hardware_rev)
 
 
-sensors_characteristics_uuid = [CHAR_UUID_DATETIME, CHAR_UUID_TEMPERATURE, CHAR_UUID_HUMIDITY, CHAR_UUID_RADON_1DAYAVG,
-                                CHAR_UUID_RADON_LONG_TERM_AVG, CHAR_UUID_ILLUMINANCE_ACCELEROMETER,
-                                CHAR_UUID_WAVE_PLUS_DATA,CHAR_UUID_WAVE_2_DATA,CHAR_UUID_WAVEMINI_DATA,
-                                COMMAND_UUID]
-
-sensors_characteristics_uuid_str = [str(x) for x in sensors_characteristics_uuid]
+class CommandChannel:
+    # Request/response channel over the access control point of a device.
+    # The notifications are subscribed once per connection and each response
+    # is matched to its request by the command byte. The response timeout
+    # adapts to the measured round trip times of the device.
+    INITIAL_TIMEOUT = 1.0
+    MIN_TIMEOUT = 0.3
+    MAX_TIMEOUT = 5.0
 
+    def __init__(self, mac):
+        self.mac = mac
+        self.subscribed = False
+        self.timeout = self.INITIAL_TIMEOUT
+        self._pending = {}
+        self._srtt = None
+        self._rttvar = None
 
-class BaseDecode:
-    def __init__(self, name, format_type, scale):
-        self.name = name
-        self.format_type = format_type
-        self.scale = scale
-
-    def decode_data(self, raw_data):
-        val = struct.unpack(
-            self.format_type,
-            raw_data)
-        if len(val) == 1:
-            res = val[0] * self.scale
+    def notification_handler(self, sender, data):
+        _LOGGER.debug("Notification handler: %s: %s: %s", self.mac, sender, data)
+        if not data:
+            return
+        future = self._pending.pop(data[0], None)
+        if future is None or future.done():
+            _LOGGER.debug("Unexpected response %s from %s", bytes(data[0:1]).hex(), self.mac)
+            return
+        future.set_result(data)
+
+    def _update_timeout(self, rtt):
+        # Same estimator as the TCP retransmission timeout
+        if self._srtt is None:
+            self._srtt = rtt
+            self._rttvar = rtt / 2
         else:
-            res = val
-        return {self.name:res}
-
-
-class WavePlussDecode(BaseDecode):
-    def decode_data(self, raw_data):
-        val = super().decode_data(raw_data)
-        val = val[self.name]
-        data = {}
-        data['date_time'] = str(datetime.isoformat(datetime.now()))
-        data['humidity'] = val[1]/2.0
-        data['radon_1day_avg'] = val[4] if 0 <= val[4] <= 16383 else None
-        data['radon_longterm_avg'] = val[5] if 0 <= val[5] <= 16383 else None
-        data['temperature'] = val[6]/100.0
-        data['rel_atm_pressure'] = val[7]/50.0
-        data['co2'] = val[8]*1.0
-        data['voc'] = val[9]*1.0
-        return data
-
-
-class Wave2Decode(BaseDecode):
-    def decode_data(self, raw_data):
-        val = super().decode_data(raw_data)
-        val = val[self.name]
-        data = {}
-        data['date_time'] = str(datetime.isoformat(datetime.now()))
-        data['humidity'] = val[1]/2.0
-        data['radon_1day_avg'] = val[4] if 0 <= val[4] <= 16383 else None
-        data['radon_longterm_avg'] = val[5] if 0 <= val[5] <= 16383 else None
-        data['temperature'] = val[6]/100.0
-        return data
-
-
-class WaveMiniDecode(BaseDecode):
-    def decode_data(self, raw_data):
-        val = super().decode_data(raw_data)
-        val = val[self.name]
-        data = {}
-        data['date_time'] = str(datetime.isoformat(datetime.now()))
-        data['temperature'] = round( val[1]/100.0 - 273.15,2)
-        data['humidity'] = val[3]/100.0
-        data['voc'] = val[4]*1.0
-        return data
-
-
-class WaveDecodeDate(BaseDecode):
-    def decode_data(self, raw_data):
-        val = super().decode_data(raw_data)[self.name]
-        data = {self.name:str(datetime(val[0], val[1], val[2], val[3], val[4], val[5]).isoformat())}
-        return data
-
-
-class WaveDecodeIluminAccel(BaseDecode):
-    def decode_data(self, raw_data):
-        val = super().decode_data(raw_data)[self.name]
-        data = {}
-        data['illuminance'] = str(val[0] * self.scale)
-        data['accelerometer'] = str(val[1] * self.scale)
+            self._rttvar = 0.75 * self._rttvar + 0.25 * abs(self._srtt - rtt)
+            self._srtt = 0.875 * self._srtt + 0.125 * rtt
+        self.timeout = max(self.MIN_TIMEOUT, min(self.MAX_TIMEOUT, self._srtt + 4 * self._rttvar))
+
+    async def request(self, client, uuid, cmd):
+        # Send cmd and wait for its response, returns None on timeout
+        if not self.subscribed:
+            await client.start_notify(uuid, self.notification_handler)
+            self.subscribed = True
+        future = asyncio.get_running_loop().create_future()
+        self._pending[cmd[0]] = future
+        start = time.monotonic()
+        await client.write_gatt_char(uuid, cmd)
+        try:
+            data = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self._pending.pop(cmd[0], None)
+            _LOGGER.warning("Timeout getting command data from %s after %.1fs", self.mac, self.timeout)
+            self.timeout = min(self.MAX_TIMEOUT, self.timeout * 2)
+            return None
+        self._update_timeout(time.monotonic() - start)
         return data
 
-
-class CommandDecode:
-    def __init__(self, name, format_type, cmd):
-        self.name = name
-        self.format_type = format_type
-        self.cmd = cmd
-
-    def decode_data(self, raw_data):
-        if raw_data is None:
-            return {}
-        cmd = raw_data[0:1]
-        if cmd != self.cmd:
-            _LOGGER.warning("Result for Wrong command received, expected {} got {}".format(self.cmd.hex(), cmd.hex()))
-            return {}
-        
-        if len(raw_data[2:]) != struct.calcsize(self.format_type):
-            _LOGGER.debug("Wrong length data received ({}) verses expected ({})".format(len(cmd), struct.calcsize(self.format_type)))
-            return {}
-        val = struct.unpack(
-            self.format_type,
-            raw_data[2:])
-        res = {}
-        res['illuminance'] = val[2]
-        #res['measurement_periods'] =  val[5]
-        res['battery'] = val[17] / 1000.0
-
-        return res
-
-sensor_decoders = {str(CHAR_UUID_WAVE_PLUS_DATA):WavePlussDecode(name="Pluss", format_type='BBBBHHHHHHHH', scale=0),
-                   str(CHAR_UUID_DATETIME):WaveDecodeDate(name="date_time", format_type='HBBBBB', scale=0),
-                   str(CHAR_UUID_HUMIDITY):BaseDecode(name="humidity", format_type='H', scale=1.0/100.0),
-                   str(CHAR_UUID_RADON_1DAYAVG):BaseDecode(name="radon_1day_avg", format_type='H', scale=1.0),
-                   str(CHAR_UUID_RADON_LONG_TERM_AVG):BaseDecode(name="radon_longterm_avg", format_type='H', scale=1.0),
-                   str(CHAR_UUID_ILLUMINANCE_ACCELEROMETER):WaveDecodeIluminAccel(name="illuminance_accelerometer", format_type='BB', scale=1.0),
-                   str(CHAR_UUID_TEMPERATURE):BaseDecode(name="temperature", format_type='h', scale=1.0/100.0),
-                   str(CHAR_UUID_WAVE_2_DATA):Wave2Decode(name="Wave2", format_type='<4B8H', scale=1.0),
-                   str(CHAR_UUID_WAVEMINI_DATA):WaveMiniDecode(name="WaveMini", format_type='<HHHHHHLL', scale=1.0),}
-
-command_decoders = {str(COMMAND_UUID):CommandDecode(name="Battery", format_type='<L12B6H', cmd=struct.pack('<B', 0x6d))}
+    def reset(self):
+        # The subscription ends with the connection
+        self.subscribed = False
+        for future in self._pending.values():
+            future.cancel()
+        self._pending = {}
+
+
+class DeviceSlot:
+    # Connection slot of a device on its adapter, held while the device is
+    # handled. A connection kept open between polls keeps holding its slot,
+    # so kept connections count against the max_connections of the adapter
+    # like the active ones. Devices out of rotation take no slot.
+    def __init__(self, detect, mac):
+        self.detect = detect
+        self.session = detect.session(mac)
+
+    async def __aenter__(self):
+        session = self.session
+        session.users += 1
+        breaker = session.breaker
+        if breaker.state == CircuitBreaker.OPEN and breaker.retry_in > 0:
+            # connect() skips the device
+            return
+        try:
+            await self.detect.acquire_slot(session)
+        except BaseException:
+            session.users -= 1
+            raise
+
+    async def __aexit__(self, *exc_info):
+        session = self.session
+        session.users -= 1
+        if session.users == 0 and not (session.kept and session.is_connected):
+            session.release_slot()
+        return False
+
+
+class AirthingsDeviceSession:
+    # Connection and command state for a single device, so that several
+    # devices can be polled at the same time without sharing a client.
+    def __init__(self, mac):
+        self.mac = mac
+        self.client = None
+        # Adapter the client was created on
+        self.adapter = None
+        self.commands = CommandChannel(mac)
+        self.breaker = CircuitBreaker()
+        # Time of the last read of each characteristic
+        self.last_read = {}
+        # Whether the characteristics can be read as a pipelined group, and
+        # the polls in a row where pipelined reads failed
+        self.pipelined = True
+        self.pipeline_failures = 0
+        # Whether the connection may be kept open between polls
+        self.keep_alive = True
+        self.kept = False
+        self.drops = 0
+        self.closing = False
+        # Adapter whose connection slot is held for the device, and number
+        # of tasks handling the device, see DeviceSlot
+        self.held_slot = None
+        self.users = 0
+
+    @property
+    def is_connected(self):
+        return self.client is not None and self.client.is_connected
+
+    def release_slot(self):
+        if self.held_slot is not None:
+            self.held_slot.slot().release()
+            self.held_slot = None
+
+    def disconnected_callback(self, client):
+        self.kept = False
+        self.commands.reset()
+        if self.users == 0:
+            # A kept connection dropped while idle
+            self.release_slot()
+        if self.closing:
+            return
+        self.drops += 1
+        _LOGGER.debug("%s disconnected (%s times)", self.mac, self.drops)
+        if self.keep_alive and self.drops >= MAX_KEEP_ALIVE_DROPS:
+            _LOGGER.info("%s keeps dropping the connection, connecting for every poll instead", self.mac)
+            self.keep_alive = False
 
 
 class AirthingsWaveDetect:
-    def __init__(self, scan_interval, mac=None):
+    def __init__(self, scan_interval, mac=None, max_connections=1, cache=None, transport=None,
+                 connection_policy=None, keep_alive=0, refresh_intervals=None, history=None,
+                 adapters=None, capture=None, pipelined_reads=True):
         self.airthing_devices = [] if mac is None else [mac]
-        self.sensors = []
+        self.sensors = {}
         self.sensordata = {}
         self.scan_interval = scan_interval
         self.last_scan = -1
-        self._dev = None
-        self._command_data = None
-
-    def notification_handler(self, sender, data):
-        _LOGGER.debug("Notification handler: {0}: {1}".format(sender, data))
-        self._command_data = data
-        self._event.set()
-    
-    async def find_devices(self, scans=2, timeout=5):
-        # Search for devices, scan for BLE devices scans times for timeout seconds
-        # Get manufacturer data and try to match it to airthings ID.
-        
+        # Maximum number of devices connected at the same time on each adapter
+        self.max_connections = max(1, max_connections)
+        # Bluetooth adapters (hci0, ...) the devices are spread over, None
+        # for the default adapter only.
+        self.adapters = AdapterPool(adapters, self.max_connections)
+        # Number of devices kept connected between polls on each adapter, 0
+        # to connect for every poll. A kept connection holds a connection
+        # slot, one slot of each adapter always stays free for the polls.
+        self.keep_alive = keep_alive
+        # Minimum seconds between reads of a value, values not listed are
+        # read on every poll.
+        self.refresh_intervals = refresh_intervals or {}
+        # Read the characteristics of a device as one pipelined group
+        self.pipelined_reads = pipelined_reads
+        self.devices = {}
+        # ReadPlan of each device, compiled once its characteristics are known
+        self._plans = {}
+        self._sessions = {}
+        self._scan_lock = None
+        # AirthingsDeviceCache with the info and characteristics of known
+        # devices, the devices loaded from it are verified on first connect.
+        self.cache = cache
+        self._unverified = set()
+        self._discovery_scanners = []
+        # Creates the Bluetooth clients and scanners
+        if transport is None:
+            # Only needed with real devices, see BleakTransport
+            from .transport import BleakTransport
+            transport = BleakTransport()
+        self.transport = transport
+        if capture is not None:
+            # Record all the traffic to the capture file, see capture.py
+            self.transport = CaptureTransport(self.transport, capture)
+        self.connection_policy = ConnectionPolicy() if connection_policy is None else connection_policy
+        # Per-device counters and latencies of the polls, see metrics.py
+        self.metrics = PollMetrics()
+        # ReadingHistory recording the values of every poll, None to only
+        # keep the latest values.
+        self.history = history
+
+    def session(self, mac):
+        if mac not in self._sessions:
+            self._sessions[mac] = AirthingsDeviceSession(mac)
+        return self._sessions[mac]
+
+    async def _for_each_device(self, macs, func):
+        # Run func(mac) for every device, with at most max_connections
+        # devices being handled concurrently on each adapter.
+        async def run(mac):
+            async with self._connection_slot(mac):
+                await func(mac)
+
+        await asyncio.gather(*[run(mac) for mac in macs])
+
+    def _connection_slot(self, mac):
+        return DeviceSlot(self, mac)
+
+    async def acquire_slot(self, session):
+        # Take a connection slot on the current adapter of the device
+        adapter = self.adapters.adapter(session.mac)
+        if session.held_slot is not adapter:
+            session.release_slot()
+            await adapter.slot().acquire()
+            session.held_slot = adapter
+
+    def _scanners(self, detection_callback):
+        # One scanner per adapter, detection_callback(device, advertisement_data, adapter)
+        scanners = []
+        for name in self.adapters.names:
+            if name is None:
+                scanners.append(self.transport.scanner(
+                    lambda device, advertisement_data: detection_callback(device, advertisement_data, None)))
+            else:
+                scanners.append(self.transport.scanner(
+                    lambda device, advertisement_data, name=name: detection_callback(device, advertisement_data, name),
+                    adapter=name))
+        return scanners
+
+    def _discovered(self, device, advertisement_data, adapter=None):
+        # Returns True if the advertisement is from an airthings device that
+        # was not known yet.
+        if AIRTHINGS_MANUFACTURER_ID not in advertisement_data.manufacturer_data:
+            return False
+        # The signal of known devices is recorded too, to pick their adapter
+        self.adapters.record_rssi(device.address, adapter, getattr(device, "rssi", None))
+        if device.address.upper() in (mac.upper() for mac in self.airthing_devices):
+            return False
+        _LOGGER.debug("Discovered airthings device %s", device.address)
+        self.airthing_devices.append(device.address)
+        return True
+
+    def _expected_found(self, expected):
+        # expected is either a number of devices or a collection of macs
+        if expected is None:
+            return False
+        if isinstance(expected, int):
+            return len(self.airthing_devices) >= expected
+        found = set(mac.upper() for mac in self.airthing_devices)
+        return all(mac.upper() in found for mac in expected)
+
+    async def find_devices(self, scans=2, timeout=5, expected=None):
+        # Search for devices, scan for BLE devices for up to scans * timeout seconds
+        # and match the manufacturer data of the advertisements to the airthings ID.
+        # When expected (number of devices or macs) is given, the scan stops as
+        # soon as the expected devices have been seen.
         _LOGGER.debug("Scanning for airthings devices")
-        for _count in range(scans):
-            advertisements = await BleakScanner.discover(timeout)
-            for adv in advertisements:
-                if 820 in adv.metadata["manufacturer_data"]: # TODO: Not sure if this is the best way to identify Airthings devices
-                    if adv.address not in self.airthing_devices:
-                        self.airthing_devices.append(adv.address)
-
-        _LOGGER.debug("Found {} airthings devices".format(len(self.airthing_devices)))
+        if self._expected_found(expected):
+            return len(self.airthing_devices)
+        found = asyncio.Event()
+
+        def detection_callback(device, advertisement_data, adapter):
+            if self._discovered(device, advertisement_data, adapter) and self._expected_found(expected):
+                found.set()
+
+        scanners = self._scanners(detection_callback)
+        for scanner in scanners:
+            await scanner.start()
+        try:
+            await asyncio.wait_for(found.wait(), scans * timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            for scanner in scanners:
+                await scanner.stop()
+
+        _LOGGER.debug("Found %s airthings devices", len(self.airthing_devices))
         return len(self.airthing_devices)
 
-    async def connect(self, mac, retries=10):  
-        _LOGGER.debug("Connecting to {}".format(mac))
-        await self.disconnect()
+    async def start_discovery(self, on_device):
+        # Keep scanning in the background, on_device(mac) is called for every
+        # airthings device seen for the first time.
+        if self._discovery_scanners:
+            return
+
+        def detection_callback(device, advertisement_data, adapter):
+            if self._discovered(device, advertisement_data, adapter):
+                on_device(device.address)
+
+        scanners = self._scanners(detection_callback)
+        started = []
+        try:
+            for scanner in scanners:
+                await scanner.start()
+                started.append(scanner)
+        except Exception:
+            # Stop the scanners that did start so discovery can be retried
+            for scanner in started:
+                await scanner.stop()
+            raise
+        self._discovery_scanners = scanners
+
+    async def stop_discovery(self):
+        for scanner in self._discovery_scanners:
+            await scanner.stop()
+        self._discovery_scanners = []
+
+    async def connect(self, mac, retries=None):
+        session = self.session(mac)
+        if not session.breaker.allow():
+            _LOGGER.debug("Not connecting to %s, next try in %.0fs", mac, session.breaker.retry_in)
+            return session
+        try:
+            return await self._connect(session, retries)
+        except BaseException:
+            # Cancelled, for example at shutdown. A probe that never records
+            # its result would keep the breaker half open for good.
+            session.breaker.abandon()
+            raise
+
+    async def _connect(self, session, retries):
+        mac = session.mac
+        adapter = self.adapters.adapter(mac)
+        if session.client is not None and session.adapter != adapter.name:
+            # The device moved to another adapter
+            await self.disconnect(mac)
+            session.client = None
+        if session.is_connected:
+            _LOGGER.debug("Reusing connection to %s", mac)
+            return session
+        _LOGGER.debug("Connecting to %s", mac)
+        policy = self.connection_policy
+        retries = policy.retries if retries is None else retries
+        deadline = time.monotonic() + policy.deadline
+        metrics = self.metrics.device(mac)
         tries = 0
         while (tries < retries):
             tries += 1
+            if tries > 1:
+                metrics.retries += 1
+            timeout = min(policy.timeout, deadline - time.monotonic())
+            start = time.monotonic()
             try:
-                self._dev = BleakClient(mac.lower())
-                ret = await self._dev.connect()
+                # The client is kept on the session and reused for every
+                # connection to the device, it is only recreated after errors.
+                if session.client is None:
+                    session.commands.reset()
+                    # Give pipelined reads another chance on a new client
+                    session.pipelined = True
+                    session.pipeline_failures = 0
+                    kwargs = {} if adapter.name is None else {"adapter": adapter.name}
+                    session.client = self.transport.client(
+                        mac.lower(), disconnected_callback=session.disconnected_callback, **kwargs)
+                    session.adapter = adapter.name
+                ret = await asyncio.wait_for(session.client.connect(timeout=timeout), timeout)
+                metrics.connect_time.observe(time.monotonic() - start)
                 if ret:
-                    _LOGGER.debug("Connected to {}".format(mac))
+                    _LOGGER.debug("Connected to %s", mac)
                     break
             except Exception as e:
-                if tries == retries:
-                    _LOGGER.info("Not able to connect to {}".format(mac))
-                    pass
-                else:
-                    _LOGGER.debug("Retrying {}".format(mac))
-
-    async def disconnect(self):
-        if self._dev is not None:
-            await self._dev.disconnect()
-            self._dev = None
+                metrics.connect_time.observe(time.monotonic() - start)
+                if isinstance(e, asyncio.TimeoutError):
+                    metrics.timeouts += 1
+                _LOGGER.debug("Connecting to %s failed: %r", mac, e)
+                session.client = None
+            delay = policy.delay(tries)
+            if tries == retries or time.monotonic() + delay >= deadline:
+                break
+            _LOGGER.debug("Retrying %s in %.1fs", mac, delay)
+            # Let other devices use the adapter during the backoff
+            held = session.held_slot is not None
+            session.release_slot()
+            await asyncio.sleep(delay)
+            if held:
+                await self.acquire_slot(session)
+
+        self.adapters.record_result(mac, session.is_connected)
+        if session.is_connected:
+            metrics.connects += 1
+            session.breaker.record_success()
+        else:
+            metrics.connect_failures += 1
+            _LOGGER.info("Not able to connect to %s", mac)
+            session.breaker.record_failure()
+            if session.breaker.state == CircuitBreaker.OPEN:
+                _LOGGER.warning("Taking %s out of rotation, next try in %.0fs", mac, session.breaker.retry_in)
+                # No load on its adapter until it answers, the next probe
+                # assigns an adapter again.
+                self.adapters.remove(mac)
+        return session
+
+    def out_of_rotation(self, mac):
+        # Whether the device is skipped until its next probe, see CircuitBreaker
+        session = self._sessions.get(mac)
+        return session is not None and session.breaker.state == CircuitBreaker.OPEN
+
+    async def disconnect(self, mac):
+        session = self.session(mac)
+        session.kept = False
+        session.commands.reset()
+        if session.is_connected:
+            session.closing = True
+            try:
+                await session.client.disconnect()
+            except Exception:
+                _LOGGER.debug("Error disconnecting from %s", mac)
+                session.client = None
+            finally:
+                session.closing = False
+        if session.users == 0:
+            session.release_slot()
+
+    async def release(self, mac):
+        # Done with the device for this poll, in keep alive mode the
+        # connection stays open if the device allows it and its adapter has
+        # a slot to spare.
+        session = self.session(mac)
+        adapter = session.held_slot
+        if self.keep_alive and session.keep_alive and session.is_connected and adapter is not None:
+            kept = sum(1 for other in self._sessions.values()
+                       if other is not session and other.kept and other.is_connected
+                       and other.held_slot is adapter)
+            if kept < min(self.keep_alive, adapter.max_connections - 1):
+                session.kept = True
+                return
+        await self.disconnect(mac)
+
+    async def disconnect_all(self):
+        for mac in list(self._sessions):
+            await self.disconnect(mac)
+
+    async def close(self):
+        # Stop the discovery, close the connections and write the rest of
+        # the capture.
+        await self.stop_discovery()
+        await self.disconnect_all()
+        if isinstance(self.transport, CaptureTransport):
+            await self.transport.close()
 
     async def get_info(self):
         # Try to get some info from the discovered airthings devices
         self.devices = {}
-        for mac in self.airthing_devices:
-            await self.connect(mac)
-            if self._dev is not None and self._dev.is_connected:
-                try:   
-                    if self._dev is not None and self._dev.is_connected:
-                        device = AirthingsDeviceInfo(serial_nr=mac)
-                        for characteristic in device_info_characteristics:
-                            try:
-                                data = await self._dev.read_gatt_char(characteristic.uuid)
-                                setattr(device, characteristic.name, data.decode(characteristic.format))
-                            except:
-                                _LOGGER.exception("Error getting info")
-                                self._dev = None
-                    self.devices[mac] = device    
-                except:
-                    _LOGGER.exception("Error getting device info.")
-                await self.disconnect()
-            else:
-                _LOGGER.error("Not getting device info because failed to connect to device.")
+        await self._for_each_device(self.airthing_devices, self._get_device_info)
         return self.devices
 
+    async def _get_device_info(self, mac):
+        session = await self.connect(mac)
+        if session.is_connected:
+            await self._read_device_info(session)
+            await self.disconnect(mac)
+        else:
+            _LOGGER.error("Not getting device info because failed to connect to device.")
+
+    async def _read_device_info(self, session):
+        try:
+            device = AirthingsDeviceInfo(serial_nr=session.mac)
+            for characteristic in device_info_characteristics:
+                try:
+                    data = await session.client.read_gatt_char(characteristic.uuid)
+                    setattr(device, characteristic.name, data.decode(characteristic.format))
+                except:
+                    _LOGGER.exception("Error getting info")
+            self.devices[session.mac] = device
+        except:
+            _LOGGER.exception("Error getting device info.")
+
     async def get_sensors(self):
         self.sensors = {}
-        for mac in self.airthing_devices:
-            await self.connect(mac)
-            if self._dev is not None and self._dev.is_connected:
-                sensor_characteristics =  []
-                svcs = await self._dev.get_services()
-                for service in svcs:
-                    for characteristic in service.characteristics:
-                        _LOGGER.debug(characteristic)
-                        if characteristic.uuid in sensors_characteristics_uuid_str:
-                            sensor_characteristics.append(characteristic)
-                self.sensors[mac] = sensor_characteristics
-            await self.disconnect()                            
+        await self._for_each_device(self.airthing_devices, self._get_device_sensors)
         return self.sensors
 
+    async def _get_device_sensors(self, mac):
+        session = await self.connect(mac)
+        if session.is_connected:
+            await self._read_device_sensors(session)
+        await self.disconnect(mac)
+
+    async def _read_device_sensors(self, session):
+        sensor_characteristics =  []
+        svcs = await session.client.get_services()
+        for service in svcs:
+            for characteristic in service.characteristics:
+                _LOGGER.debug(characteristic)
+                if find_decoder(characteristic.uuid) is not None:
+                    sensor_characteristics.append(characteristic)
+        self._set_sensors(session.mac, sensor_characteristics)
+
+    def _set_sensors(self, mac, characteristics):
+        self.sensors[mac] = characteristics
+        device = self.devices.get(mac)
+        self._plans[mac] = compile_read_plan(characteristics, None if device is None else device.model_nr,
+                                             self.refresh_intervals)
+        _LOGGER.debug("%s: %s", mac, self._plans[mac])
+
+    def _is_due(self, session, characteristic, refresh_interval, now):
+        if refresh_interval <= 0:
+            return True
+        last_read = session.last_read.get(characteristic.uuid)
+        # Allow for half a scan interval of jitter, otherwise a read due a
+        # little after a poll is postponed by a whole scan interval.
+        return last_read is None or now - last_read + self.scan_interval / 2 >= refresh_interval
+
+    async def load_cache(self):
+        # Take the info and sensor characteristics of the known devices from
+        # the cache, so they do not have to be discovered and enumerated again.
+        if self.cache is None:
+            return 0
+        await self.cache.async_load()
+        macs = list(self.airthing_devices) or self.cache.macs
+        loaded = 0
+        for mac in macs:
+            info = self.cache.get_info(mac)
+            characteristics = self.cache.get_characteristics(mac)
+            if info is None or characteristics is None:
+                continue
+            self.devices[mac] = AirthingsDeviceInfo(**info)
+            self._set_sensors(mac, characteristics)
+            self._unverified.add(mac)
+            if mac not in self.airthing_devices:
+                self.airthing_devices.append(mac)
+            loaded += 1
+        _LOGGER.debug("Loaded %s airthings device(s) from cache", loaded)
+        return loaded
+
+    def _store_in_cache(self, mac):
+        if self.cache is not None and mac in self.devices and mac in self.sensors:
+            self.cache.set(mac, self.devices[mac].as_dict(), self.sensors[mac])
+
+    async def _verify_cached_device(self, session):
+        # Compare the firmware revision of the device with the cached one and
+        # read the info and characteristics again if it changed.
+        mac = session.mac
+        data = await session.client.read_gatt_char(CHAR_UUID_FIRMWARE_REV)
+        firmware_rev = data.decode("utf-8")
+        if self.cache.get(mac, firmware_rev) is None:
+            _LOGGER.info("Firmware %s seen on %s, refreshing cached device data", firmware_rev, mac)
+            await self._read_device_info(session)
+            await self._read_device_sensors(session)
+            self._store_in_cache(mac)
+            await self.cache.async_save()
+        self._unverified.discard(mac)
+
+    async def setup_devices(self):
+        # Get the info, the sensor characteristics and a first reading of
+        # every device using a single connection per device, instead of the
+        # three connections needed by get_info, get_sensors and get_sensor_data.
+        # Devices loaded from the cache only need the reading.
+        await self._for_each_device(self.airthing_devices, self._setup_device)
+        self.last_scan = time.monotonic()
+        if self.cache is not None:
+            await self.cache.async_save()
+        return self.devices
+
+    async def setup_device(self, mac):
+        # Set up a single device, returns True if a first reading was taken.
+        async with self._connection_slot(mac):
+            await self._setup_device(mac)
+        if self.cache is not None:
+            await self.cache.async_save()
+        return mac in self.sensordata
+
+    async def _setup_device(self, mac):
+        if mac in self.sensors:
+            await self._get_device_sensor_data(mac)
+            return
+        session = await self.connect(mac)
+        if not session.is_connected:
+            _LOGGER.error("Not setting up %s because failed to connect to device.", mac)
+            return
+        await self._read_device_info(session)
+        try:
+            await self._read_device_sensors(session)
+        except:
+            _LOGGER.exception("Error getting sensors of %s.", mac)
+            self.devices.pop(mac, None)
+            await self.disconnect(mac)
+            session.client = None
+            return
+        self._store_in_cache(mac)
+        await self._read_sensor_data(session)
+        await self.release(mac)
+
     async def get_sensor_data(self):
-        if time.monotonic() - self.last_scan > self.scan_interval or self.last_scan == -1:
-            self.last_scan = time.monotonic()
-            for mac, characteristics in self.sensors.items():
-                await self.connect(mac)
-                if self._dev is not None and self._dev.is_connected:
-                    try:
-                        for characteristic in characteristics:
-                            sensor_data = None
-                            if str(characteristic.uuid) in sensor_decoders:
-                                data = await self._dev.read_gatt_char(characteristic.uuid)
-                                sensor_data = sensor_decoders[str(characteristic.uuid)].decode_data(data)
-                                _LOGGER.debug("{} Got sensordata {}".format(mac, sensor_data))
-                            
-                            if str(characteristic.uuid) in command_decoders:
-                                _LOGGER.debug("command characteristic: {}".format(characteristic.uuid))
-                                # Create an Event object.
-                                self._event = asyncio.Event()
-                                # Set up the notification handlers
-                                await self._dev.start_notify(characteristic.uuid, self.notification_handler)
-                                # send command to this 'indicate' characteristic
-                                await self._dev.write_gatt_char(characteristic.uuid, command_decoders[str(characteristic.uuid)].cmd)
-                                # Wait for up to one second to see if a callblack comes in.
-                                try:
-                                    await asyncio.wait_for(self._event.wait(), 1)
-                                except asyncio.TimeoutError:
-                                    _LOGGER.warn("Timeout getting command data.")
-                                if self._command_data is not None:
-                                    sensor_data = command_decoders[str(characteristic.uuid)].decode_data(self._command_data)
-                                    self._command_data = None
-                                # Stop notification handler
-                                await self._dev.stop_notify(characteristic.uuid)
-
-                            if sensor_data is not None:
-                                if self.sensordata.get(mac) is None:
-                                    self.sensordata[mac] = sensor_data
-                                else:
-                                    self.sensordata[mac].update(sensor_data)                
-                    except:
-                        _LOGGER.exception("Error getting sensor data.")
-                        self._dev = None
-
-                await self.disconnect()
+        # Callers arriving while a scan is running wait for it to finish
+        # instead of returning the data from the previous scan.
+        if self._scan_lock is None:
+            self._scan_lock = asyncio.Lock()
+        async with self._scan_lock:
+            if time.monotonic() - self.last_scan > self.scan_interval or self.last_scan == -1:
+                self.last_scan = time.monotonic()
+                await self._for_each_device(list(self.sensors), self._get_device_sensor_data)
 
         return self.sensordata
 
+    async def get_device_sensor_data(self, mac):
+        # Read a single device, returns the new snapshot of its data or None
+        # if the device could not be read.
+        async with self._connection_slot(mac):
+            success = await self._get_device_sensor_data(mac)
+        return self.sensordata.get(mac) if success else None
+
+    async def _get_device_sensor_data(self, mac):
+        success = False
+        start = time.monotonic()
+        session = await self.connect(mac)
+        connected = session.is_connected
+        if connected:
+            success = await self._read_sensor_data(session)
+        await self.release(mac)
+        if success:
+            self.metrics.poll_succeeded(mac, time.monotonic() - start)
+        else:
+            self.metrics.poll_failed(mac, time.monotonic() - start,
+                                     "read failed" if connected else "not connected")
+        return success
+
+    async def _read_characteristics(self, session, characteristics, metrics):
+        # Read the characteristics as one pipelined group, so the requests
+        # are queued on the connection together instead of waiting for each
+        # response before sending the next request. The reads that fail are
+        # retried one at a time, and devices where that keeps working for
+        # MAX_PIPELINE_FAILURES polls in a row are read one at a time until
+        # the next new client.
+        if self.pipelined_reads and session.pipelined and len(characteristics) > 1:
+            start = time.monotonic()
+            metrics.reads += len(characteristics)
+            results = await asyncio.gather(
+                *[session.client.read_gatt_char(c.uuid) for c in characteristics], return_exceptions=True)
+            failed = [i for i, result in enumerate(results) if isinstance(result, Exception)]
+            elapsed = (time.monotonic() - start) / len(characteristics)
+            for _i in range(len(characteristics) - len(failed)):
+                metrics.read_time.observe(elapsed)
+            if not failed:
+                session.pipeline_failures = 0
+                return results
+            metrics.read_errors += 1
+            _LOGGER.debug("Pipelined reads of %s failed: %r, reading %d again one at a time",
+                          session.mac, results[failed[0]], len(failed))
+            retried = await self._read_sequentially(session, [characteristics[i] for i in failed], metrics)
+            for i, result in zip(failed, retried):
+                results[i] = result
+            session.pipeline_failures += 1
+            if session.pipeline_failures >= MAX_PIPELINE_FAILURES:
+                _LOGGER.info("%s does not support pipelined reads, reading one at a time", session.mac)
+                session.pipelined = False
+            return results
+        return await self._read_sequentially(session, characteristics, metrics)
+
+    async def _read_sequentially(self, session, characteristics, metrics):
+        results = []
+        for characteristic in characteristics:
+            metrics.reads += 1
+            start = time.monotonic()
+            results.append(await session.client.read_gatt_char(characteristic.uuid))
+            metrics.read_time.observe(time.monotonic() - start)
+        return results
+
+    async def _read_sensor_data(self, session):
+        mac = session.mac
+        metrics = self.metrics.device(mac)
+        try:
+            if mac in self._unverified:
+                await self._verify_cached_device(session)
+            # The values are decoded into a new reading that replaces the
+            # previous one once the device has been read, so readers never
+            # see a partially updated device.
+            reading = Reading()
+            now = time.monotonic()
+            plan = self._plans[mac]
+            reads = []
+            for step in plan.reads:
+                if self._is_due(session, step.characteristic, step.refresh_interval, now):
+                    reads.append((step.characteristic, step.decoder))
+            commands = []
+            for step in plan.commands:
+                if self._is_due(session, step.characteristic, step.refresh_interval, now):
+                    commands.append((step.characteristic, step.decoder))
+
+            results = await self._read_characteristics(session, [c for c, _ in reads], metrics)
+            received = list(zip(reads, results))
+            for characteristic, decoder in commands:
+                _LOGGER.debug("command characteristic: %s", characteristic.uuid)
+                # send command to this 'indicate' characteristic
+                metrics.commands += 1
+                start = time.monotonic()
+                data = await session.commands.request(session.client, characteristic.uuid, decoder.cmd)
+                metrics.command_time.observe(time.monotonic() - start)
+                if data is None:
+                    metrics.command_timeouts += 1
+                received.append(((characteristic, decoder), data))
+
+            decoded = []
+            for (characteristic, decoder), data in received:
+                if data is not None:
+                    start = time.perf_counter()
+                    if decoder.decode_into(reading, data) is not False:
+                        decoded.append(characteristic.uuid)
+                    metrics.decode_time.observe(time.perf_counter() - start)
+            # Only the values that were read count as refreshed, the others
+            # are read again on the next poll.
+            for uuid in decoded:
+                session.last_read[uuid] = now
+            _LOGGER.debug("%s Got sensordata %s", mac, reading)
+        except:
+            metrics.read_errors += 1
+            _LOGGER.exception("Error getting sensor data.")
+            await self.disconnect(mac)
+            session.client = None
+            if self.cache is not None and self.cache.get(mac) is not None:
+                # The cached characteristics may be stale, check them on the
+                # next connection.
+                self.cache.invalidate(mac)
+                self._unverified.add(mac)
+                await self.cache.async_save()
+            return False
+
+        if self.history is not None:
+            self.history.add(mac, reading.measurements(), reading.timestamp)
+        # Values not read in this poll are carried over
+        reading.carry_over(self.sensordata.get(mac))
+        self.sensordata[mac] = reading
+        return True
+
 async def main():
     logging.basicConfig()
     _LOGGER.setLevel(logging.DEBUG)
     ad = AirthingsWaveDetect(0)
     num_dev_found = await ad.find_devices()
     if num_dev_found > 0:
-        devices = await ad.get_info()
+        devices = await ad.setup_devices()
         for mac, dev in devices.items():
-            _LOGGER.info("Device: {}: {}".format(mac, dev))
+            _LOGGER.info("Device: %s: %s", mac, dev)
 
-        devices_sensors = await ad.get_sensors()
-        for mac, sensors in devices_sensors.items():
+        for mac, sensors in ad.sensors.items():
             for sensor in sensors:
-                _LOGGER.info("Sensor: {}: {}".format(mac, sensor))
+                _LOGGER.info("Sensor: %s: %s", mac, sensor)
 
-        sensordata = await ad.get_sensor_data()
-        for mac, data in sensordata.items():
+        for mac, data in ad.sensordata.items():
             for name, val in data.items():
-                _LOGGER.info("Sensor data: {}: {}: {}".format(mac, name, val))
+                _LOGGER.info("Sensor data: %s: %s: %s", mac, name, val)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,129 @@
+"""Persistent cache of Airthings device metadata."""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import json
+import logging
+import os
+from collections import namedtuple
+
+_LOGGER = logging.getLogger(__name__)
+
+# Bump when the layout of the cache file changes, older files are ignored.
+CACHE_VERSION = 1
+
+# Stand-in for the characteristics returned by the service enumeration, only
+# the fields used when reading the device are kept.
+CachedCharacteristic = namedtuple('CachedCharacteristic', ['uuid', 'handle'])
+
+
+class AirthingsDeviceCache:
+    # Device info and sensor characteristics of each device, keyed by mac and
+    # stored together with the firmware revision they were read from. Kept in
+    # a JSON file by the daemon, Home Assistant keeps it in its own storage
+    # (AirthingsStorageCache in sensor.py).
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        self._dirty = False
+        self._lock = None
+
+    def load(self):
+        try:
+            with open(self.path, encoding="utf-8") as cache_file:
+                content = json.load(cache_file)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            _LOGGER.warning("Not able to read device cache %s", self.path)
+            return
+        if content.get("version") != CACHE_VERSION:
+            _LOGGER.info("Ignoring device cache with version %s", content.get("version"))
+            return
+        self._entries = content.get("devices", {})
+        _LOGGER.debug("Loaded %d device(s) from cache", len(self._entries))
+
+    def _dump(self):
+        self._dirty = False
+        return json.dumps({"version": CACHE_VERSION, "devices": self._entries}, indent=2)
+
+    def _write(self, content):
+        tmp_path = "{}.tmp".format(self.path)
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(tmp_path, "w", encoding="utf-8") as cache_file:
+                cache_file.write(content)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            _LOGGER.warning("Not able to write device cache %s", self.path)
+            self._dirty = True
+
+    def save(self):
+        if self._dirty:
+            self._write(self._dump())
+
+    async def async_load(self):
+        await asyncio.get_running_loop().run_in_executor(None, self.load)
+
+    async def async_save(self):
+        # The entries are serialized on the event loop, where they are
+        # changed, and one save at a time writes the file in an executor.
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._dirty:
+                await asyncio.get_running_loop().run_in_executor(None, self._write, self._dump())
+
+    @property
+    def macs(self):
+        return list(self._entries)
+
+    def get(self, mac, firmware_rev=None):
+        entry = self._entries.get(mac)
+        if entry is None:
+            return None
+        if firmware_rev is not None and entry["firmware_rev"] != firmware_rev:
+            return None
+        return entry
+
+    def get_info(self, mac):
+        entry = self.get(mac)
+        return None if entry is None else dict(entry["info"])
+
+    def get_characteristics(self, mac):
+        entry = self.get(mac)
+        if entry is None:
+            return None
+        return [CachedCharacteristic(uuid, handle) for uuid, handle in entry["characteristics"]]
+
+    def set(self, mac, info, characteristics):
+        # info is a dict of the AirthingsDeviceInfo fields
+        self._entries[mac] = {
+            "firmware_rev": info.get("firmware_rev", ""),
+            "info": dict(info),
+            "characteristics": [[str(c.uuid), c.handle] for c in characteristics],
+        }
+        self._dirty = True
+
+    def invalidate(self, mac):
+        if self._entries.pop(mac, None) is not None:
+            _LOGGER.debug("Invalidated cached data of %s", mac)
+            self._dirty = True
@@ -0,0 +1,497 @@
+"""Capture and replay of the Bluetooth traffic of the Airthings devices."""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import logging
+import os
+import struct
+import sys
+import time
+from collections import namedtuple
+from uuid import UUID
+
+_LOGGER = logging.getLogger(__name__)
+
+# File layout: MAGIC, version and wall clock time of the start of the
+# capture, followed by records of a RECORD header and length bytes of data.
+MAGIC = b"ATWCAP"
+VERSION = 1
+FILE_HEADER = struct.Struct("<Bd")
+# Seconds since the start, duration of the operation, event, mac, uuid
+# index and length of the data.
+RECORD = struct.Struct("<dfB6sHH")
+NO_UUID = 0xFFFF
+
+# Size after which the capture file is rotated, and the rotated files kept
+# as <path>.1 (the newest) to <path>.<CAPTURE_BACKUPS>.
+MAX_CAPTURE_SIZE = 10 * 1024 * 1024
+CAPTURE_BACKUPS = 3
+
+# Events, UUID_DEF assigns the uuid in the data to the uuid index
+UUID_DEF = 0
+CONNECT = 1
+CONNECT_FAILED = 2
+DISCONNECT = 3
+SERVICES = 4
+READ = 5
+READ_ERROR = 6
+WRITE = 7
+NOTIFY = 8
+ADVERTISEMENT = 9
+
+EVENT_NAMES = {UUID_DEF: "uuid", CONNECT: "connect", CONNECT_FAILED: "connect_failed",
+               DISCONNECT: "disconnect", SERVICES: "services", READ: "read", READ_ERROR: "read_error",
+               WRITE: "write", NOTIFY: "notify", ADVERTISEMENT: "advertisement"}
+
+CaptureRecord = namedtuple('CaptureRecord', ['time', 'duration', 'event', 'mac', 'uuid', 'data'])
+ReplayCharacteristic = namedtuple('ReplayCharacteristic', ['uuid', 'handle'])
+ReplayService = namedtuple('ReplayService', ['uuid', 'characteristics'])
+ReplayBLEDevice = namedtuple('ReplayBLEDevice', ['address', 'name', 'rssi'])
+ReplayAdvertisement = namedtuple('ReplayAdvertisement', ['manufacturer_data'])
+
+
+class ReplayError(Exception):
+    pass
+
+
+def _mac_bytes(mac):
+    return bytes.fromhex(mac.replace(":", ""))
+
+
+def _mac_str(data):
+    return ":".join("{:02X}".format(b) for b in data)
+
+
+def _uuid_str(uuid):
+    return str(getattr(uuid, "uuid", uuid)).lower()
+
+
+class CaptureWriter:
+    # Appends the records to a capture file, uuids are written once and
+    # referred to by their index afterwards. The records are collected in
+    # memory and written in an executor every flush_interval seconds and on
+    # close(), so the event loop never waits for the disk. The file is
+    # rotated at startup and once it grows beyond max_size, every file
+    # starts with the header, the uuids and the services of the devices so
+    # it can be replayed on its own.
+    def __init__(self, path, flush_interval=5.0, max_size=MAX_CAPTURE_SIZE, backups=CAPTURE_BACKUPS):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+        self.backups = backups
+        self.start = time.monotonic()
+        self.started_at = time.time()
+        self._uuids = {}
+        # Latest services record of each device
+        self._services = {}
+        self._buffer = bytearray()
+        self._file = None
+        self._closed = False
+        self._flush_handle = None
+        self._flush_task = None
+        self._lock = None
+
+    def _uuid_index(self, uuid):
+        if uuid is None:
+            return NO_UUID
+        uuid = _uuid_str(uuid)
+        index = self._uuids.get(uuid)
+        if index is None:
+            index = len(self._uuids)
+            self._uuids[uuid] = index
+            self._write(UUID_DEF, None, index, UUID(uuid).bytes, 0.0, 0.0)
+        return index
+
+    def _write(self, event, mac, uuid_index, data, timestamp, duration):
+        self._buffer += RECORD.pack(timestamp, duration, event, b"\0" * 6 if mac is None else _mac_bytes(mac),
+                                    uuid_index, len(data))
+        self._buffer += data
+
+    def record(self, event, mac, uuid=None, data=b"", started=None):
+        # started is the monotonic time the operation started, now if None
+        if self._closed:
+            return
+        now = time.monotonic()
+        started = now if started is None else started
+        self._write(event, mac, self._uuid_index(uuid), bytes(data), started - self.start, now - started)
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(self.flush_interval, self._flush_later)
+
+    def _flush_later(self):
+        self._flush_handle = None
+        self._flush_task = asyncio.ensure_future(self.flush())
+
+    def _preamble(self):
+        # Header, uuid definitions and services starting every file
+        preamble = bytearray(MAGIC + FILE_HEADER.pack(VERSION, self.started_at))
+        for uuid, index in self._uuids.items():
+            preamble += RECORD.pack(0.0, 0.0, UUID_DEF, b"\0" * 6, index, 16) + UUID(uuid).bytes
+        for mac, data in self._services.items():
+            preamble += RECORD.pack(0.0, 0.0, SERVICES, _mac_bytes(mac), NO_UUID, len(data)) + data
+        return bytes(preamble)
+
+    def _rotate(self):
+        for index in range(self.backups, 0, -1):
+            source = self.path if index == 1 else "{}.{}".format(self.path, index - 1)
+            if os.path.exists(source):
+                os.replace(source, "{}.{}".format(self.path, index))
+        if self.backups <= 0 and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _write_file(self, data, preamble):
+        if self._file is not None and self._file.tell() + len(data) > self.max_size \
+                and self._file.tell() > len(preamble):
+            self._file.close()
+            self._file = None
+        if self._file is None:
+            self._rotate()
+            self._file = open(self.path, "wb")
+            self._file.write(preamble)
+        self._file.write(data)
+        self._file.flush()
+
+    async def flush(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if not self._buffer or (self._file is not None and self._file.closed):
+                return
+            data, self._buffer = bytes(self._buffer), bytearray()
+            try:
+                await asyncio.get_running_loop().run_in_executor(None, self._write_file, data, self._preamble())
+            except OSError:
+                _LOGGER.exception("Not able to write capture file %s", self.path)
+
+    def record_services(self, mac, services, started):
+        data = bytearray()
+        for service in services:
+            for characteristic in service.characteristics:
+                data += struct.pack("<HH", self._uuid_index(characteristic.uuid), characteristic.handle)
+        self._services[mac] = bytes(data)
+        self.record(SERVICES, mac, data=data, started=started)
+
+    async def close(self):
+        # Write the remaining records and close the file
+        if self._closed:
+            return
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._flush_task is not None:
+            await self._flush_task
+            self._flush_task = None
+        await self.flush()
+        self._closed = True
+        if self._file is not None:
+            await asyncio.get_running_loop().run_in_executor(None, self._file.close)
+
+
+def read_capture(path):
+    # Yields the CaptureRecord of every event of a capture file
+    with open(path, "rb") as capture_file:
+        header = capture_file.read(len(MAGIC) + FILE_HEADER.size)
+        if header[:len(MAGIC)] != MAGIC:
+            raise ReplayError("{} is not a capture file".format(path))
+        version, _started = FILE_HEADER.unpack(header[len(MAGIC):])
+        if version != VERSION:
+            raise ReplayError("Unsupported capture version {}".format(version))
+        uuids = {}
+        while True:
+            record = capture_file.read(RECORD.size)
+            if len(record) < RECORD.size:
+                return
+            timestamp, duration, event, mac, uuid_index, length = RECORD.unpack(record)
+            data = capture_file.read(length)
+            if event == UUID_DEF:
+                uuids[uuid_index] = str(UUID(bytes=data))
+                continue
+            if event == SERVICES:
+                data = [ReplayCharacteristic(uuids[index], handle)
+                        for index, handle in struct.iter_unpack("<HH", data)]
+            yield CaptureRecord(timestamp, duration, event, _mac_str(mac), uuids.get(uuid_index), data)
+
+
+class CaptureClient:
+    # Wraps a client of another transport and records its traffic
+    def __init__(self, writer, client, mac):
+        self._writer = writer
+        self._client = client
+        self._mac = mac
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    @property
+    def is_connected(self):
+        return self._client.is_connected
+
+    async def connect(self, **kwargs):
+        started = time.monotonic()
+        try:
+            ret = await self._client.connect(**kwargs)
+        except BaseException as e:
+            self._writer.record(CONNECT_FAILED, self._mac, data=repr(e).encode("utf-8"), started=started)
+            raise
+        self._writer.record(CONNECT if ret else CONNECT_FAILED, self._mac, started=started)
+        return ret
+
+    async def get_services(self):
+        started = time.monotonic()
+        services = await self._client.get_services()
+        self._writer.record_services(self._mac, services, started)
+        return services
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        started = time.monotonic()
+        try:
+            data = await self._client.read_gatt_char(char_specifier, **kwargs)
+        except Exception as e:
+            self._writer.record(READ_ERROR, self._mac, char_specifier, repr(e).encode("utf-8"), started)
+            raise
+        self._writer.record(READ, self._mac, char_specifier, data, started)
+        return data
+
+    async def write_gatt_char(self, char_specifier, data, response=False):
+        started = time.monotonic()
+        await self._client.write_gatt_char(char_specifier, data, response)
+        self._writer.record(WRITE, self._mac, char_specifier, data, started)
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        def capture_callback(sender, data):
+            self._writer.record(NOTIFY, self._mac, char_specifier, data)
+            callback(sender, data)
+
+        await self._client.start_notify(char_specifier, capture_callback, **kwargs)
+
+
+class CaptureTransport:
+    # Records the traffic of the clients and scanners of transport to path
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.writer = CaptureWriter(path)
+
+    def client(self, mac, disconnected_callback=None, **kwargs):
+        def capture_disconnected(client):
+            self.writer.record(DISCONNECT, mac)
+            if disconnected_callback is not None:
+                disconnected_callback(client)
+
+        return CaptureClient(self.writer, self.transport.client(
+            mac, disconnected_callback=capture_disconnected, **kwargs), mac)
+
+    def scanner(self, detection_callback, **kwargs):
+        def capture_detection(device, advertisement_data):
+            data = struct.pack("<b", max(-128, min(127, int(getattr(device, "rssi", None) or 0))))
+            data += b"".join(struct.pack("<H", company) for company in advertisement_data.manufacturer_data)
+            self.writer.record(ADVERTISEMENT, device.address, data=data)
+            detection_callback(device, advertisement_data)
+
+        return self.transport.scanner(capture_detection, **kwargs)
+
+    async def close(self):
+        await self.writer.close()
+
+
+class ReplayQueue:
+    # Recorded events of one kind, replayed in order and from the start
+    # again once exhausted when looping.
+    def __init__(self, loop):
+        self.events = []
+        self.loop = loop
+        self._next = 0
+
+    def pop(self, what):
+        if self._next >= len(self.events):
+            if not self.loop or not self.events:
+                raise ReplayError("No more {} in the capture".format(what))
+            self._next = 0
+        event = self.events[self._next]
+        self._next += 1
+        return event
+
+
+class ReplayClient:
+    # Implements the parts of BleakClient used by AirthingsWaveDetect from
+    # the recorded events of the device.
+    def __init__(self, transport, address, disconnected_callback=None, **kwargs):
+        self.transport = transport
+        self.address = address
+        self.mac = address.upper()
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        self._notify_callbacks = {}
+
+    async def connect(self, **kwargs):
+        ok, duration = self.transport.queue(CONNECT, self.mac).pop("connections")
+        await self.transport.delay(duration)
+        if not ok:
+            raise ReplayError("Recorded connection to {} failed".format(self.address))
+        self.is_connected = True
+        return True
+
+    async def disconnect(self):
+        self.drop()
+        return True
+
+    def drop(self):
+        if self.is_connected:
+            self.is_connected = False
+            self._notify_callbacks = {}
+            if self.disconnected_callback is not None:
+                self.disconnected_callback(self)
+
+    def _check_connected(self):
+        if not self.is_connected:
+            raise ReplayError("Not connected to {}".format(self.address))
+
+    async def get_services(self):
+        self._check_connected()
+        characteristics, duration = self.transport.queue(SERVICES, self.mac).pop("services")
+        await self.transport.delay(duration)
+        return [ReplayService("b42e1c08-ade7-11e4-89d3-123b93f75cba", characteristics)]
+
+    async def read_gatt_char(self, char_specifier, **kwargs):
+        self._check_connected()
+        uuid = _uuid_str(char_specifier)
+        ok, data, duration = self.transport.queue(READ, self.mac, uuid).pop("reads of {}".format(uuid))
+        await self.transport.delay(duration)
+        if not ok:
+            raise ReplayError("Recorded read of {} failed".format(uuid))
+        return bytearray(data)
+
+    async def write_gatt_char(self, char_specifier, data, response=False):
+        self._check_connected()
+        uuid = _uuid_str(char_specifier)
+        callback = self._notify_callbacks.get(uuid)
+        queue = self.transport.queue(NOTIFY, self.mac, uuid)
+        if callback is not None and queue.events:
+            delay, response_data = queue.pop("notifications of {}".format(uuid))
+            asyncio.get_running_loop().call_later(self.transport.scaled(delay), callback, uuid,
+                                                  bytearray(response_data))
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        self._check_connected()
+        self._notify_callbacks[_uuid_str(char_specifier)] = callback
+
+    async def stop_notify(self, char_specifier):
+        self._notify_callbacks.pop(_uuid_str(char_specifier), None)
+
+
+class ReplayScanner:
+    # Replays the recorded advertisements with their recorded spacing
+    def __init__(self, transport, detection_callback, **kwargs):
+        self.transport = transport
+        self.detection_callback = detection_callback
+        self._task = None
+
+    async def _advertise(self):
+        previous = None
+        for timestamp, mac, rssi, companies in self.transport.advertisements:
+            if previous is not None:
+                await self.transport.delay(timestamp - previous)
+            previous = timestamp
+            self.detection_callback(ReplayBLEDevice(mac, "Airthings", rssi),
+                                    ReplayAdvertisement({company: b"" for company in companies}))
+
+    async def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._advertise())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class ReplayTransport:
+    # Drop-in replacement for BleakTransport serving the traffic of a capture
+    # file. The recorded durations are divided by speed, a speed of 0 replays
+    # without any delay. With loop the recorded values are served again once
+    # all of them have been used.
+    def __init__(self, path, speed=1.0, loop=True):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.devices = set()
+        self.advertisements = []
+        self._queues = {}
+        self._load()
+
+    def queue(self, *key):
+        if key not in self._queues:
+            self._queues[key] = ReplayQueue(self.loop)
+        return self._queues[key]
+
+    def _load(self):
+        writes = {}
+        for record in read_capture(self.path):
+            mac = record.mac
+            if record.event == ADVERTISEMENT:
+                rssi = struct.unpack_from("<b", record.data)[0]
+                companies = [company for (company,) in struct.iter_unpack("<H", record.data[1:])]
+                self.advertisements.append((record.time, mac, rssi, companies))
+                continue
+            self.devices.add(mac)
+            if record.event in (CONNECT, CONNECT_FAILED):
+                self.queue(CONNECT, mac).events.append((record.event == CONNECT, record.duration))
+            elif record.event == SERVICES:
+                self.queue(SERVICES, mac).events.append((record.data, record.duration))
+            elif record.event in (READ, READ_ERROR):
+                self.queue(READ, mac, record.uuid).events.append(
+                    (record.event == READ, record.data, record.duration))
+            elif record.event == WRITE:
+                writes[(mac, record.uuid)] = record.time + record.duration
+            elif record.event == NOTIFY:
+                # Delay of the notification after the write it answers
+                written = writes.pop((mac, record.uuid), record.time)
+                self.queue(NOTIFY, mac, record.uuid).events.append((max(0.0, record.time - written), record.data))
+        _LOGGER.debug("Loaded %d device(s) and %d advertisement(s) from %s",
+                      len(self.devices), len(self.advertisements), self.path)
+
+    def scaled(self, seconds):
+        return 0.0 if self.speed <= 0 else seconds / self.speed
+
+    async def delay(self, seconds):
+        if self.speed > 0 and seconds > 0:
+            await asyncio.sleep(seconds / self.speed)
+
+    def client(self, mac, **kwargs):
+        return ReplayClient(self, mac, **kwargs)
+
+    def scanner(self, detection_callback, **kwargs):
+        return ReplayScanner(self, detection_callback, **kwargs)
+
+
+def main():
+    # Print the records of a capture file
+    if len(sys.argv) != 2:
+        print("Usage: python -m custom_components.airthings_wave.capture <capture file>")
+        return
+    for record in read_capture(sys.argv[1]):
+        if record.event == SERVICES:
+            data = " ".join("{}:{}".format(c.uuid, c.handle) for c in record.data)
+        else:
+            data = bytes(record.data).hex()
+        print("{:12.6f} {:9.6f} {:<14} {} {} {}".format(record.time, record.duration, EVENT_NAMES[record.event],
+                                                          record.mac, record.uuid or "-", data))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+"""Connection retry policy and circuit breaker for the Airthings devices."""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import random
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class ConnectionPolicy:
+    # How hard to try connecting to a device: up to retries attempts of at
+    # most timeout seconds each, separated by a capped exponential backoff
+    # with jitter, and all of it within deadline seconds.
+    def __init__(self, retries=5, timeout=30, deadline=90, backoff=1.0, max_backoff=16.0, jitter=0.5):
+        self.retries = retries
+        self.timeout = timeout
+        self.deadline = deadline
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        # Delay after the given failed attempt (starting at 1)
+        delay = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return delay * random.uniform(1.0 - self.jitter, 1.0)
+
+
+class CircuitBreaker:
+    # Takes a device out of rotation after failure_threshold consecutive
+    # failed connections. After reset_timeout seconds a single probe is let
+    # through, the timeout doubles (up to max_reset_timeout) every time the
+    # probe fails and the device is back in rotation once a probe succeeds.
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=3, reset_timeout=300, max_reset_timeout=3600):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self._current_timeout = reset_timeout
+        self._opened_at = None
+
+    def allow(self):
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self._current_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            return True
+        # Only one probe at a time while half open
+        return self.state == self.CLOSED
+
+    def record_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+        self._current_timeout = self.reset_timeout
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN:
+            self._current_timeout = min(self.max_reset_timeout, self._current_timeout * 2)
+            self._open()
+        elif self.state == self.CLOSED and self.failures >= self.failure_threshold:
+            self._open()
+
+    def abandon(self):
+        # The probe ended without a result, wait for the next one
+        if self.state == self.HALF_OPEN:
+            self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened_at = time.monotonic()
+
+    @property
+    def retry_in(self):
+        # Seconds until the next probe is allowed
+        if self.state != self.OPEN:
+            return 0
+        return max(0, self._current_timeout - (time.monotonic() - self._opened_at))
@@ -0,0 +1,233 @@
+"""Headless collector polling Airthings devices without Home Assistant.
+
+Run from the directory holding custom_components with:
+
+    python -m custom_components.airthings_wave.daemon --config collector.json
+"""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import argparse
+import asyncio
+import json
+import logging
+import signal
+
+from .airthings import AirthingsWaveDetect
+from .cache import AirthingsDeviceCache
+from .capture import ReplayTransport
+from .connection import ConnectionPolicy
+from .exporters import create_sink
+from .scheduler import AdaptiveInterval, StaggeredSlots
+
+_LOGGER = logging.getLogger(__name__)
+
+# Backoff of the setup of devices that did not answer, in seconds
+SETUP_RETRY_INTERVAL = 60
+MAX_SETUP_RETRY_INTERVAL = 3600
+
+DEFAULT_CONFIG = {
+    "mac": None,
+    "scan_interval": 300,
+    "min_scan_interval": None,
+    "max_scan_interval": None,
+    "max_connections": 1,
+    # Bluetooth adapters the devices are spread over, null for the default one
+    "adapters": None,
+    "expected_devices": None,
+    "continuous_discovery": False,
+    "keep_alive": 0,
+    "connect_timeout": 30,
+    "refresh_intervals": {"battery": 86400, "radon_longterm_avg": 3600},
+    "cache_file": None,
+    # Number of simulated devices polled instead of real ones, for testing
+    "simulate": 0,
+    # Record the Bluetooth traffic to this file, see capture.py
+    "capture_file": None,
+    # Replay a capture file instead of using Bluetooth
+    "replay_file": None,
+    "replay_speed": 1.0,
+    "replay_loop": True,
+    "sinks": [{"type": "jsonl"}],
+}
+
+
+def load_config(path):
+    with open(path, encoding="utf-8") as config_file:
+        content = json.load(config_file)
+    unknown = set(content) - set(DEFAULT_CONFIG)
+    if unknown:
+        raise ValueError("Unknown option(s) in {}: {}".format(path, ", ".join(sorted(unknown))))
+    config = dict(DEFAULT_CONFIG)
+    config.update(content)
+    return config
+
+
+class AirthingsCollector:
+    # Polls the devices continuously, each in its own time slot of the scan
+    # interval, and hands every reading to the sinks.
+    def __init__(self, config, transport=None):
+        self.config = dict(DEFAULT_CONFIG, **config)
+        # Simulated and replayed devices are known without scanning
+        self.offline = bool(self.config["simulate"] or self.config["replay_file"])
+        if transport is None and self.config["replay_file"]:
+            transport = ReplayTransport(self.config["replay_file"], speed=self.config["replay_speed"],
+                                        loop=self.config["replay_loop"])
+        if transport is None and self.config["simulate"]:
+            from .simulator import SimulatedTransport
+            transport = SimulatedTransport(connect_latency=0.05, read_latency=0.01,
+                                           adapters=self.config["adapters"])
+            transport.add_devices(self.config["simulate"])
+        scan_interval = self.config["scan_interval"]
+        cache_file = self.config["cache_file"]
+        self.detect = AirthingsWaveDetect(scan_interval, self.config["mac"],
+                                          max_connections=self.config["max_connections"],
+                                          cache=None if cache_file is None else AirthingsDeviceCache(cache_file),
+                                          transport=transport,
+                                          connection_policy=ConnectionPolicy(timeout=self.config["connect_timeout"]),
+                                          keep_alive=self.config["keep_alive"],
+                                          refresh_intervals=self.config["refresh_intervals"],
+                                          adapters=self.config["adapters"],
+                                          capture=self.config["capture_file"])
+        if self.offline and self.config["mac"] is None:
+            self.detect.airthing_devices = list(transport.devices)
+        self.scheduler = AdaptiveInterval(scan_interval,
+                                          self.config["min_scan_interval"] or scan_interval,
+                                          self.config["max_scan_interval"] or scan_interval)
+        self.slots = StaggeredSlots()
+        self.sinks = [create_sink(sink) for sink in self.config["sinks"]]
+        self._tasks = {}
+
+    async def start(self):
+        for sink in self.sinks:
+            await sink.start()
+        detect = self.detect
+        mac = self.config["mac"]
+        if mac is None and not self.offline:
+            num_devices_cached = await detect.load_cache()
+            if num_devices_cached > 0:
+                _LOGGER.info("Using %d cached airthings device(s)", num_devices_cached)
+            # Still search, for devices added since the cache was written
+            num_devices_found = await detect.find_devices(expected=self.config["expected_devices"])
+            _LOGGER.info("Found %d airthings device(s)", num_devices_found)
+        devices_info = await detect.setup_devices()
+        for mac, dev in devices_info.items():
+            _LOGGER.info("%s: %s", mac, dev)
+        for mac in list(detect.airthing_devices):
+            if mac in detect.sensordata:
+                self._add_device(mac)
+            else:
+                # Out of range or busy, set up once it answers
+                self._tasks[mac] = asyncio.create_task(self._setup_device(mac))
+        if self.config["mac"] is None and self.config["continuous_discovery"]:
+            await detect.start_discovery(self._device_discovered)
+
+    def _add_device(self, mac):
+        self.publish(mac, self.detect.sensordata[mac])
+        self.slots.add(mac)
+        self._tasks[mac] = asyncio.create_task(self._poll_device(mac))
+
+    def _device_discovered(self, mac):
+        if mac not in self._tasks:
+            _LOGGER.info("Setting up discovered airthings device %s", mac)
+            self._tasks[mac] = asyncio.create_task(self._setup_device(mac))
+
+    async def _setup_device(self, mac):
+        # Retried with backoff until the device answers, its poll task then
+        # replaces this task in _tasks.
+        delay = SETUP_RETRY_INTERVAL
+        while True:
+            try:
+                if await self.detect.setup_device(mac):
+                    break
+            except Exception:
+                _LOGGER.exception("Failed to set up airthings device %s", mac)
+            _LOGGER.warning("Failed to set up airthings device %s, retrying in %.0fs", mac, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_SETUP_RETRY_INTERVAL)
+        _LOGGER.info("%s: %s", mac, self.detect.devices.get(mac))
+        self._add_device(mac)
+
+    def publish(self, mac, data):
+        for sink in self.sinks:
+            sink.submit(mac, data, data.timestamp)
+
+    async def _poll_device(self, mac):
+        data = self.detect.sensordata[mac]
+        while True:
+            if self.scheduler.enabled:
+                interval = self.scheduler.next_interval(mac, data)
+            else:
+                interval = self.scheduler.base_interval
+            await asyncio.sleep(self.slots.delay(mac, interval))
+            try:
+                new_data = await self.detect.get_device_sensor_data(mac)
+            except Exception:
+                _LOGGER.exception("Failed to read data from %s", mac)
+                continue
+            if new_data is None:
+                _LOGGER.info("Failed to read data from %s", mac)
+                if self.detect.out_of_rotation(mac):
+                    # Give its time slot to the other devices until it answers
+                    self.slots.remove(mac)
+                    self.scheduler.remove(mac)
+                continue
+            self.slots.add(mac)
+            data = new_data
+            self.publish(mac, data)
+
+    async def stop(self):
+        await self.detect.stop_discovery()
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks = {}
+        await self.detect.close()
+        for sink in self.sinks:
+            await sink.stop()
+
+
+async def run(config):
+    collector = AirthingsCollector(config)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    await collector.start()
+    try:
+        await stop.wait()
+    finally:
+        _LOGGER.info("Stopping")
+        await collector.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--config", "-c", help="JSON config file, see README.md")
+    parser.add_argument("--verbose", "-v", action="store_true", help="log debug messages")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    config = dict(DEFAULT_CONFIG) if args.config is None else load_config(args.config)
+    asyncio.run(run(config))
+
+
+if __name__ == "__main__":
+    main()
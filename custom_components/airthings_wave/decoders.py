@@ -0,0 +1,233 @@
+"""Decoders for the sensor characteristics of the Airthings devices."""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import struct
+import time
+from collections.abc import Mapping
+from datetime import datetime
+from uuid import UUID
+
+_LOGGER = logging.getLogger(__name__)
+
+CHAR_UUID_DATETIME = UUID('00002a08-0000-1000-8000-00805f9b34fb')
+CHAR_UUID_TEMPERATURE = UUID('00002a6e-0000-1000-8000-00805f9b34fb')
+CHAR_UUID_HUMIDITY = UUID('00002a6f-0000-1000-8000-00805f9b34fb')
+CHAR_UUID_RADON_1DAYAVG = UUID('b42e01aa-ade7-11e4-89d3-123b93f75cba')
+CHAR_UUID_RADON_LONG_TERM_AVG = UUID('b42e0a4c-ade7-11e4-89d3-123b93f75cba')
+CHAR_UUID_ILLUMINANCE_ACCELEROMETER = UUID('b42e1348-ade7-11e4-89d3-123b93f75cba')
+CHAR_UUID_WAVE_PLUS_DATA = UUID('b42e2a68-ade7-11e4-89d3-123b93f75cba')
+CHAR_UUID_WAVE_2_DATA = UUID('b42e4dcc-ade7-11e4-89d3-123b93f75cba')
+CHAR_UUID_WAVEMINI_DATA = UUID('b42e3b98-ade7-11e4-89d3-123b93f75cba')
+COMMAND_UUID = UUID('b42e2d06-ade7-11e4-89d3-123b93f75cba') # "Access Control Point" Characteristic
+
+
+class Reading(Mapping):
+    # Values of one poll of a device, read like a dict of the values by name.
+    # The values are kept in slots, a value the device did not report is left
+    # unset, and the time of the reading is kept as a float that is only
+    # formatted when date_time is looked up.
+    VALUES = ('humidity', 'radon_1day_avg', 'radon_longterm_avg', 'temperature',
+              'rel_atm_pressure', 'co2', 'voc', 'illuminance', 'accelerometer', 'battery')
+    __slots__ = ('timestamp', 'device_time') + VALUES
+    _names = frozenset(VALUES)
+
+    def __init__(self, timestamp=None):
+        # Seconds since the epoch when the device was read
+        self.timestamp = time.time() if timestamp is None else timestamp
+
+    @classmethod
+    def from_dict(cls, values, timestamp=None):
+        # Reading of the values of a dict such as dict(reading), received
+        # from a collector. Unknown names and values that are not numbers
+        # are skipped.
+        reading = cls(timestamp)
+        for name, value in values.items():
+            if name == 'date_time' and isinstance(value, str):
+                reading.device_time = datetime.fromisoformat(value).timestamp()
+            elif name in cls._names and (value is None or (isinstance(value, (int, float))
+                                                           and not isinstance(value, bool))):
+                setattr(reading, name, value)
+        return reading
+
+    @property
+    def date_time(self):
+        # The clock of the device when it has one, else the time of the read
+        return datetime.fromtimestamp(getattr(self, 'device_time', self.timestamp)).isoformat()
+
+    def __getitem__(self, name):
+        if name == 'date_time':
+            return self.date_time
+        if name in self._names:
+            try:
+                return getattr(self, name)
+            except AttributeError:
+                pass
+        raise KeyError(name)
+
+    def __contains__(self, name):
+        return name == 'date_time' or (name in self._names and hasattr(self, name))
+
+    def __iter__(self):
+        yield 'date_time'
+        for name in self.VALUES:
+            if hasattr(self, name):
+                yield name
+
+    def __len__(self):
+        return 1 + sum(1 for name in self.VALUES if hasattr(self, name))
+
+    def __repr__(self):
+        return "Reading({})".format(dict(self))
+
+    def measurements(self):
+        # (name, value) of the numeric values, without formatting the time
+        for name in self.VALUES:
+            value = getattr(self, name, None)
+            if value is not None:
+                yield name, value
+
+    def carry_over(self, previous):
+        # Take the values that were not read in this poll from the previous
+        # reading of the device.
+        if previous is None:
+            return
+        for name in self.VALUES:
+            if not hasattr(self, name) and hasattr(previous, name):
+                setattr(self, name, getattr(previous, name))
+
+
+class BaseDecode:
+    # Names of the values in the decoded data
+    fields = None
+
+    def __init__(self, name, format_type, scale):
+        self.name = name
+        self.format_type = format_type
+        self.scale = scale
+        # Compiled once instead of parsing the format string for every packet
+        self.struct = struct.Struct(format_type)
+        if self.fields is None:
+            self.fields = (name,)
+
+    def decode_into(self, reading, raw_data):
+        val = self.struct.unpack(raw_data)
+        setattr(reading, self.name, val[0] * self.scale)
+
+
+class WavePlussDecode(BaseDecode):
+    fields = ('date_time', 'humidity', 'radon_1day_avg', 'radon_longterm_avg', 'temperature',
+              'rel_atm_pressure', 'co2', 'voc')
+
+    def decode_into(self, reading, raw_data):
+        val = self.struct.unpack(raw_data)
+        reading.humidity = val[1]/2.0
+        reading.radon_1day_avg = val[4] if 0 <= val[4] <= 16383 else None
+        reading.radon_longterm_avg = val[5] if 0 <= val[5] <= 16383 else None
+        reading.temperature = val[6]/100.0
+        reading.rel_atm_pressure = val[7]/50.0
+        reading.co2 = val[8]*1.0
+        reading.voc = val[9]*1.0
+
+
+class Wave2Decode(BaseDecode):
+    fields = ('date_time', 'humidity', 'radon_1day_avg', 'radon_longterm_avg', 'temperature')
+
+    def decode_into(self, reading, raw_data):
+        val = self.struct.unpack(raw_data)
+        reading.humidity = val[1]/2.0
+        reading.radon_1day_avg = val[4] if 0 <= val[4] <= 16383 else None
+        reading.radon_longterm_avg = val[5] if 0 <= val[5] <= 16383 else None
+        reading.temperature = val[6]/100.0
+
+
+class WaveMiniDecode(BaseDecode):
+    fields = ('date_time', 'temperature', 'humidity', 'voc')
+
+    def decode_into(self, reading, raw_data):
+        val = self.struct.unpack(raw_data)
+        reading.temperature = round( val[1]/100.0 - 273.15,2)
+        reading.humidity = val[3]/100.0
+        reading.voc = val[4]*1.0
+
+
+class WaveDecodeDate(BaseDecode):
+    def decode_into(self, reading, raw_data):
+        val = self.struct.unpack(raw_data)
+        reading.device_time = datetime(val[0], val[1], val[2], val[3], val[4], val[5]).timestamp()
+
+
+class WaveDecodeIluminAccel(BaseDecode):
+    fields = ('illuminance', 'accelerometer')
+
+    def decode_into(self, reading, raw_data):
+        val = self.struct.unpack(raw_data)
+        reading.illuminance = val[0] * self.scale
+        reading.accelerometer = val[1] * self.scale
+
+
+class CommandDecode:
+    fields = ('illuminance', 'battery')
+
+    def __init__(self, name, format_type, cmd):
+        self.name = name
+        self.format_type = format_type
+        self.cmd = cmd
+        self.struct = struct.Struct(format_type)
+
+    def decode_into(self, reading, raw_data):
+        # False when the response is not the one of the command
+        if raw_data is None:
+            return False
+        cmd = raw_data[0:1]
+        if cmd != self.cmd:
+            _LOGGER.warning("Result for Wrong command received, expected %s got %s", self.cmd.hex(), cmd.hex())
+            return False
+
+        # The response is the command, one byte and the data, which is
+        # unpacked in place instead of copying raw_data[2:]
+        if len(raw_data) - 2 != self.struct.size:
+            _LOGGER.debug("Wrong length data received (%d) verses expected (%d)", len(raw_data) - 2, self.struct.size)
+            return False
+        val = self.struct.unpack_from(raw_data, 2)
+        reading.illuminance = val[2]
+        #reading.measurement_periods = val[5]
+        reading.battery = val[17] / 1000.0
+        return True
+
+sensor_decoders = {str(CHAR_UUID_WAVE_PLUS_DATA):WavePlussDecode(name="Pluss", format_type='BBBBHHHHHHHH', scale=0),
+                   str(CHAR_UUID_DATETIME):WaveDecodeDate(name="date_time", format_type='HBBBBB', scale=0),
+                   str(CHAR_UUID_HUMIDITY):BaseDecode(name="humidity", format_type='H', scale=1.0/100.0),
+                   str(CHAR_UUID_RADON_1DAYAVG):BaseDecode(name="radon_1day_avg", format_type='H', scale=1.0),
+                   str(CHAR_UUID_RADON_LONG_TERM_AVG):BaseDecode(name="radon_longterm_avg", format_type='H', scale=1.0),
+                   str(CHAR_UUID_ILLUMINANCE_ACCELEROMETER):WaveDecodeIluminAccel(name="illuminance_accelerometer", format_type='BB', scale=1.0),
+                   str(CHAR_UUID_TEMPERATURE):BaseDecode(name="temperature", format_type='h', scale=1.0/100.0),
+                   str(CHAR_UUID_WAVE_2_DATA):Wave2Decode(name="Wave2", format_type='<4B8H', scale=1.0),
+                   str(CHAR_UUID_WAVEMINI_DATA):WaveMiniDecode(name="WaveMini", format_type='<HHHHHHLL', scale=1.0),}
+
+command_decoders = {str(COMMAND_UUID):CommandDecode(name="Battery", format_type='<L12B6H', cmd=struct.pack('<B', 0x6d))}
+
+
+def find_decoder(uuid):
+    # Decoder of a characteristic, looked up once when the characteristics
+    # of a device are known instead of for every packet.
+    key = str(uuid).lower()
+    return sensor_decoders.get(key, command_decoders.get(key))
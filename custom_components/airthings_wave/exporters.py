@@ -0,0 +1,303 @@
+"""Output sinks of the readings of the collector daemon."""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import json
+import logging
+import socket
+import sys
+import time
+from urllib.parse import urlsplit
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class BatchingSink:
+    # Base of the sinks, readings are queued by submit() without blocking
+    # and written in batches by a task of the sink. When the sink falls
+    # behind the oldest readings are dropped.
+    def __init__(self, batch_size=100, flush_interval=1.0, max_queue=1000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._queue = None
+        self._task = None
+
+    async def start(self):
+        await self.open()
+        self._queue = asyncio.Queue(self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # Write what is queued and close the sink
+        if self._task is not None:
+            await self._queue.put(None)
+            await self._task
+            self._task = None
+        await self.close()
+
+    def submit(self, mac, data, timestamp=None):
+        record = (mac, time.time() if timestamp is None else timestamp, data)
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(record)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            record = await self._queue.get()
+            if record is None:
+                break
+            batch = [record]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    record = await asyncio.wait_for(self._queue.get(), max(0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+            try:
+                await self.write_batch(batch)
+            except Exception:
+                _LOGGER.exception("%s failed to write %d reading(s)", type(self).__name__, len(batch))
+
+    async def open(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def write_batch(self, batch):
+        raise NotImplementedError
+
+
+def to_record(mac, timestamp, data):
+    record = {"mac": mac, "timestamp": timestamp}
+    record.update(data)
+    return record
+
+
+def to_json(mac, timestamp, data):
+    return json.dumps(to_record(mac, timestamp, data), separators=(",", ":"))
+
+
+class JsonLinesSink(BatchingSink):
+    # One JSON object per reading on stdout or appended to a file, written
+    # in an executor thread.
+    def __init__(self, path=None, **kwargs):
+        super().__init__(**kwargs)
+        self.path = None if path in (None, "-") else path
+        self._file = None
+
+    async def open(self):
+        if self.path is None:
+            self._file = sys.stdout
+        else:
+            self._file = await asyncio.get_running_loop().run_in_executor(
+                None, lambda: open(self.path, "a", encoding="utf-8"))
+
+    async def close(self):
+        if self._file is not None and self._file is not sys.stdout:
+            await asyncio.get_running_loop().run_in_executor(None, self._file.close)
+        self._file = None
+
+    def _write(self, lines):
+        self._file.write(lines)
+        self._file.flush()
+
+    async def write_batch(self, batch):
+        lines = "".join(to_json(*record) + "\n" for record in batch)
+        await asyncio.get_running_loop().run_in_executor(None, self._write, lines)
+
+
+class PrometheusSink(BatchingSink):
+    # Serves the latest readings of each device in the Prometheus text
+    # format on http://host:port/metrics
+    def __init__(self, host="0.0.0.0", port=9110, prefix="airthings", **kwargs):
+        super().__init__(**kwargs)
+        self.host = host
+        self.port = port
+        self.prefix = prefix
+        self.latest = {}
+        self._server = None
+
+    async def open(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        _LOGGER.info("Serving Prometheus metrics on %s:%s", self.host, self.port)
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def write_batch(self, batch):
+        for mac, timestamp, data in batch:
+            self.latest[mac] = (timestamp, data)
+
+    def render(self):
+        metrics = {}
+        for mac, (timestamp, data) in sorted(self.latest.items()):
+            label = '{{mac="{}"}}'.format(mac)
+            metrics.setdefault("last_update_timestamp_seconds", []).append((label, timestamp))
+            for name, value in data.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                metrics.setdefault(name, []).append((label, value))
+        lines = []
+        for name in sorted(metrics):
+            metric = "{}_{}".format(self.prefix, name)
+            lines.append("# TYPE {} gauge".format(metric))
+            lines.extend("{}{} {}".format(metric, label, value) for label, value in metrics[name])
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readline(), 10)
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] in ("/", "/metrics"):
+                status, body = "200 OK", self.render().encode("utf-8")
+            else:
+                status, body = "404 Not Found", b"Not found\n"
+            writer.write("HTTP/1.1 {}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                         "Content-Length: {}\r\nConnection: close\r\n\r\n".format(status, len(body)).encode("latin-1"))
+            writer.write(body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+class MqttSink(BatchingSink):
+    # Publishes the latest reading of each device of a batch as JSON to
+    # <topic>/<mac without colons>, reconnecting on the next batch after
+    # errors. The MQTT client is only imported by the daemon when an mqtt
+    # sink is configured, Home Assistant never loads it.
+    def __init__(self, host="localhost", port=1883, topic="airthings", retain=False,
+                 client_id="airthings_wave", username=None, password=None, keepalive=60, **kwargs):
+        from .mqtt import MqttClient
+
+        super().__init__(**kwargs)
+        self.topic = topic
+        self.retain = retain
+        self.client = MqttClient(host, port, client_id=client_id, username=username,
+                                 password=password, keepalive=keepalive)
+
+    async def close(self):
+        await self.client.close()
+
+    async def write_batch(self, batch):
+        from .mqtt import MqttError
+
+        if not self.client.is_connected:
+            try:
+                await self.client.connect()
+            except (OSError, asyncio.TimeoutError, MqttError) as e:
+                _LOGGER.warning("Not able to connect to MQTT broker %s:%s: %r, dropping %d reading(s)",
+                                self.client.host, self.client.port, e, len(batch))
+                return
+        latest = {}
+        for mac, timestamp, data in batch:
+            latest[mac] = (timestamp, data)
+        try:
+            for mac, (timestamp, data) in latest.items():
+                self.client.publish("{}/{}".format(self.topic, mac.replace(":", "").lower()),
+                                    to_json(mac, timestamp, data), retain=self.retain)
+            await self.client.drain()
+        except (OSError, MqttError) as e:
+            _LOGGER.warning("Publishing to MQTT broker failed: %r", e)
+            await self.client.close()
+
+
+class HttpSink(BatchingSink):
+    # Posts every batch as JSON to the aggregator of a Home Assistant
+    # instance or of another host, see aggregator.py. Batches that cannot
+    # be delivered are dropped, the aggregator only needs the latest
+    # readings.
+    def __init__(self, url="http://localhost:8765/readings", collector=None, token=None,
+                 timeout=10, **kwargs):
+        super().__init__(**kwargs)
+        parts = urlsplit(url)
+        if parts.scheme != "http" or not parts.hostname:
+            raise ValueError("Expected an http:// URL, got {}".format(url))
+        self.url = url
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.path = parts.path or "/readings"
+        # Name of this collector, the aggregator reads each device from one
+        # collector at a time.
+        self.collector = collector or socket.gethostname()
+        self.token = token
+        self.timeout = timeout
+
+    async def write_batch(self, batch):
+        body = json.dumps({"collector": self.collector,
+                           "readings": [to_record(*record) for record in batch]},
+                          separators=(",", ":")).encode("utf-8")
+        headers = ["POST {} HTTP/1.1".format(self.path),
+                   "Host: {}:{}".format(self.host, self.port),
+                   "Content-Type: application/json",
+                   "Content-Length: {}".format(len(body)),
+                   "Connection: close"]
+        if self.token is not None:
+            headers.append("Authorization: Bearer {}".format(self.token))
+        writer = None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+            writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + body)
+            await writer.drain()
+            status = await asyncio.wait_for(reader.readline(), self.timeout)
+            parts = status.decode("latin-1").split()
+            if len(parts) < 2 or not parts[1].startswith("2"):
+                _LOGGER.warning("Aggregator %s rejected %d reading(s): %s", self.url, len(batch),
+                                status.decode("latin-1").strip())
+        except (OSError, asyncio.TimeoutError) as e:
+            _LOGGER.warning("Not able to post %d reading(s) to %s: %r", len(batch), self.url, e)
+        finally:
+            if writer is not None:
+                writer.close()
+
+
+SINKS = {
+    "jsonl": JsonLinesSink,
+    "prometheus": PrometheusSink,
+    "mqtt": MqttSink,
+    "http": HttpSink,
+}
+
+
+def create_sink(config):
+    # config is a dict with the type of the sink and its keyword arguments
+    config = dict(config)
+    sink_type = config.pop("type", None)
+    if sink_type not in SINKS:
+        raise ValueError("Unknown sink type {}, expected one of {}".format(sink_type, ", ".join(SINKS)))
+    return SINKS[sink_type](**config)
@@ -0,0 +1,107 @@
+"""In-memory history of the readings of the Airthings devices."""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import time
+from array import array
+
+# Length of the window of the rolling statistics in seconds
+DEFAULT_WINDOW = 86400
+
+
+class SeriesBuffer:
+    # Fixed size ring buffer of the (timestamp, value) pairs of one value,
+    # backed by two arrays of doubles so its memory never grows.
+    def __init__(self, size):
+        self.size = size
+        self.times = array('d', bytes(8 * size))
+        self.values = array('d', bytes(8 * size))
+        self.count = 0
+        self._next = 0
+
+    def append(self, timestamp, value):
+        self.times[self._next] = timestamp
+        self.values[self._next] = value
+        self._next = (self._next + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def __len__(self):
+        return self.count
+
+    def items(self, since=None):
+        # (timestamp, value) pairs from the oldest to the newest
+        start = (self._next - self.count) % self.size
+        for i in range(self.count):
+            index = (start + i) % self.size
+            if since is None or self.times[index] >= since:
+                yield self.times[index], self.values[index]
+
+    def stats(self, window=DEFAULT_WINDOW, now=None):
+        # Min, max, mean and trend (change per hour, least squares) of the
+        # values of the last window seconds, None when there are no values.
+        now = time.time() if now is None else now
+        n = 0
+        minimum = maximum = None
+        sum_t = sum_v = sum_tt = sum_tv = 0.0
+        for timestamp, value in self.items(now - window):
+            # Relative to now to keep the sums small
+            t = (timestamp - now) / 3600.0
+            n += 1
+            sum_t += t
+            sum_v += value
+            sum_tt += t * t
+            sum_tv += t * value
+            if minimum is None or value < minimum:
+                minimum = value
+            if maximum is None or value > maximum:
+                maximum = value
+        if n == 0:
+            return None
+        trend = None
+        denominator = n * sum_tt - sum_t * sum_t
+        if n > 1 and denominator > 0:
+            trend = (n * sum_tv - sum_t * sum_v) / denominator
+        return {'min': minimum, 'max': maximum, 'mean': sum_v / n, 'trend': trend, 'count': n}
+
+
+class ReadingHistory:
+    # Ring buffers of the numeric values of every device, keyed by mac and
+    # value name, each holding the last size readings.
+    def __init__(self, size, window=DEFAULT_WINDOW):
+        self.size = size
+        self.window = window
+        self._series = {}
+
+    def add(self, mac, measurements, timestamp=None):
+        # measurements are the (name, value) pairs of Reading.measurements()
+        timestamp = time.time() if timestamp is None else timestamp
+        series = self._series.setdefault(mac, {})
+        for name, value in measurements:
+            if name not in series:
+                series[name] = SeriesBuffer(self.size)
+            series[name].append(timestamp, value)
+
+    def series(self, mac, name):
+        return self._series.get(mac, {}).get(name)
+
+    def stats(self, mac, name, now=None):
+        series = self.series(mac, name)
+        return None if series is None else series.stats(self.window, now)
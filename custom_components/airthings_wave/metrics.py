@@ -0,0 +1,115 @@
+"""Metrics of the polling of the Airthings devices."""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import bisect
+import time
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+
+
+class LatencyHistogram:
+    # Fixed bucket histogram of durations in seconds
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return self.sum / self.count if self.count else None
+
+    def percentile(self, pct):
+        # Upper bound of the bucket holding the percentile
+        if not self.count:
+            return None
+        rank = pct / 100.0 * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def as_dict(self):
+        return {"count": self.count, "sum": self.sum, "max": self.max, "mean": self.mean,
+                "p50": self.percentile(50), "p90": self.percentile(90), "p99": self.percentile(99),
+                "buckets": dict(zip(self.buckets, self.counts))}
+
+
+class DeviceMetrics:
+    COUNTERS = ("polls", "poll_failures", "connects", "connect_failures", "retries",
+                "timeouts", "reads", "read_errors", "commands", "command_timeouts",
+                "state_writes", "suppressed_writes", "duplicates", "failovers")
+    HISTOGRAMS = ("connect_time", "read_time", "command_time", "decode_time", "poll_time")
+
+    def __init__(self, mac):
+        self.mac = mac
+        for name in self.COUNTERS:
+            setattr(self, name, 0)
+        for name in self.HISTOGRAMS:
+            setattr(self, name, LatencyHistogram())
+        # Wall clock time of the last successful poll
+        self.last_success = None
+        self.last_error = None
+
+    def as_dict(self):
+        data = {name: getattr(self, name) for name in self.COUNTERS}
+        data.update({name: getattr(self, name).as_dict() for name in self.HISTOGRAMS})
+        data["last_success"] = self.last_success
+        data["last_error"] = self.last_error
+        return data
+
+
+class PollMetrics:
+    # Counters and latency histograms of every device, see DeviceMetrics
+    def __init__(self):
+        self.devices = {}
+
+    def device(self, mac):
+        if mac not in self.devices:
+            self.devices[mac] = DeviceMetrics(mac)
+        return self.devices[mac]
+
+    def poll_succeeded(self, mac, duration):
+        metrics = self.device(mac)
+        metrics.polls += 1
+        metrics.poll_time.observe(duration)
+        metrics.last_success = time.time()
+
+    def poll_failed(self, mac, duration, error=None):
+        metrics = self.device(mac)
+        metrics.polls += 1
+        metrics.poll_failures += 1
+        metrics.poll_time.observe(duration)
+        metrics.last_error = error
+
+    def as_dict(self):
+        return {mac: metrics.as_dict() for mac, metrics in self.devices.items()}
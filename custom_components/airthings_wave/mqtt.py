@@ -0,0 +1,164 @@
+"""Minimal MQTT 3.1.1 client publishing with QoS 0."""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import logging
+import struct
+
+_LOGGER = logging.getLogger(__name__)
+
+MQTT_PROTOCOL_LEVEL = 4
+
+# Control packet types, in the upper 4 bits of the first byte
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+
+class MqttError(Exception):
+    pass
+
+
+def encode_length(length):
+    # Variable length encoding of the remaining length
+    encoded = bytearray()
+    while True:
+        byte, length = length % 128, length // 128
+        encoded.append(byte | 0x80 if length > 0 else byte)
+        if length == 0:
+            return bytes(encoded)
+
+
+def encode_string(value):
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    return struct.pack("!H", len(value)) + value
+
+
+def packet(packet_type, body=b"", flags=0):
+    return bytes([packet_type << 4 | flags]) + encode_length(len(body)) + body
+
+
+async def read_packet(reader):
+    # Returns (type, flags, body) of the next packet
+    header = await reader.readexactly(1)
+    length = 0
+    multiplier = 1
+    while True:
+        byte = (await reader.readexactly(1))[0]
+        length += (byte & 0x7f) * multiplier
+        if not byte & 0x80:
+            break
+        multiplier *= 128
+        if multiplier > 128 ** 3:
+            raise MqttError("Malformed remaining length")
+    body = await reader.readexactly(length) if length else b""
+    return header[0] >> 4, header[0] & 0x0f, body
+
+
+class MqttClient:
+    # Publishes messages with QoS 0 over a single connection, the caller
+    # reconnects after errors.
+    def __init__(self, host, port=1883, client_id="airthings_wave", username=None,
+                 password=None, keepalive=60):
+        self.host = host
+        self.port = port
+        self.client_id = client_id
+        self.username = username
+        self.password = password
+        self.keepalive = keepalive
+        self._reader = None
+        self._writer = None
+        self._tasks = []
+
+    @property
+    def is_connected(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def connect(self, timeout=10):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), timeout)
+        flags = 0x02  # clean session
+        payload = encode_string(self.client_id)
+        if self.username is not None:
+            flags |= 0x80
+            payload += encode_string(self.username)
+            if self.password is not None:
+                flags |= 0x40
+                payload += encode_string(self.password)
+        body = encode_string("MQTT") + struct.pack("!BBH", MQTT_PROTOCOL_LEVEL, flags, self.keepalive)
+        self._writer.write(packet(CONNECT, body + payload))
+        try:
+            packet_type, _flags, body = await asyncio.wait_for(read_packet(self._reader), timeout)
+        except (asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            await self.close()
+            raise MqttError("No CONNACK from {}:{}".format(self.host, self.port)) from e
+        if packet_type != CONNACK or len(body) != 2 or body[1] != 0:
+            await self.close()
+            raise MqttError("Connection refused by {}:{} ({})".format(self.host, self.port, body.hex()))
+        _LOGGER.debug("Connected to MQTT broker %s:%s", self.host, self.port)
+        self._tasks = [asyncio.create_task(self._read_loop())]
+        if self.keepalive > 0:
+            self._tasks.append(asyncio.create_task(self._ping_loop()))
+
+    async def _read_loop(self):
+        # Only PINGRESP is expected, anything else is skipped
+        try:
+            while True:
+                await read_packet(self._reader)
+        except (asyncio.IncompleteReadError, ConnectionError, MqttError):
+            _LOGGER.debug("Connection to MQTT broker %s:%s closed", self.host, self.port)
+            if self._writer is not None:
+                self._writer.close()
+
+    async def _ping_loop(self):
+        while self.is_connected:
+            await asyncio.sleep(self.keepalive / 2.0)
+            if self.is_connected:
+                self._writer.write(packet(PINGREQ))
+
+    def publish(self, topic, payload, retain=False):
+        # Queue the message in the transport buffer, see drain()
+        if not self.is_connected:
+            raise MqttError("Not connected to {}:{}".format(self.host, self.port))
+        if isinstance(payload, str):
+            payload = payload.encode("utf-8")
+        self._writer.write(packet(PUBLISH, encode_string(topic) + payload, flags=0x01 if retain else 0))
+
+    async def drain(self):
+        await self._writer.drain()
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        if self._writer is not None:
+            if not self._writer.is_closing():
+                self._writer.write(packet(DISCONNECT))
+                self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        self._reader = self._writer = None
@@ -0,0 +1,124 @@
+"""Read plans of the Airthings devices."""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+from collections import namedtuple
+
+from .decoders import (CHAR_UUID_DATETIME, CHAR_UUID_TEMPERATURE, CHAR_UUID_HUMIDITY,
+                       CHAR_UUID_RADON_1DAYAVG, CHAR_UUID_RADON_LONG_TERM_AVG,
+                       CHAR_UUID_ILLUMINANCE_ACCELEROMETER, CHAR_UUID_WAVE_PLUS_DATA,
+                       CHAR_UUID_WAVE_2_DATA, CHAR_UUID_WAVEMINI_DATA, COMMAND_UUID,
+                       CommandDecode, find_decoder)
+
+_LOGGER = logging.getLogger(__name__)
+
+# Characteristics worth reading on each model, by the first digits of the
+# model number. Characteristics of other models are ignored when the model
+# is known.
+MODEL_CHARACTERISTICS = {
+    "2900": ("wave", [CHAR_UUID_DATETIME, CHAR_UUID_TEMPERATURE, CHAR_UUID_HUMIDITY,
+                      CHAR_UUID_RADON_1DAYAVG, CHAR_UUID_RADON_LONG_TERM_AVG,
+                      CHAR_UUID_ILLUMINANCE_ACCELEROMETER]),
+    "2920": ("wave_mini", [CHAR_UUID_WAVEMINI_DATA, COMMAND_UUID]),
+    "2930": ("wave_plus", [CHAR_UUID_WAVE_PLUS_DATA, COMMAND_UUID]),
+    "2950": ("wave_2", [CHAR_UUID_WAVE_2_DATA]),
+}
+
+# Characteristic only found on one model, to recognize the model when the
+# model number is unknown.
+MODEL_SIGNATURES = [(str(CHAR_UUID_WAVE_PLUS_DATA), "2930"),
+                    (str(CHAR_UUID_WAVE_2_DATA), "2950"),
+                    (str(CHAR_UUID_WAVEMINI_DATA), "2920"),
+                    (str(CHAR_UUID_RADON_1DAYAVG), "2900")]
+
+ReadStep = namedtuple('ReadStep', ['characteristic', 'decoder', 'fields', 'refresh_interval'])
+
+
+class ReadPlan:
+    # The characteristics to read on every poll of a device, with the fields
+    # each of them is read for and its refresh interval. Plain reads and the
+    # command requests are kept apart as they are executed differently.
+    def __init__(self, model, steps):
+        self.model = model
+        self.steps = steps
+        self.reads = [step for step in steps if not isinstance(step.decoder, CommandDecode)]
+        self.commands = [step for step in steps if isinstance(step.decoder, CommandDecode)]
+
+    @property
+    def fields(self):
+        return set(field for step in self.steps for field in step.fields)
+
+    def __repr__(self):
+        return "ReadPlan({}, {})".format(self.model, [(str(step.characteristic.uuid), step.fields)
+                                                      for step in self.steps])
+
+
+def detect_model(model_nr, uuids):
+    # Model number prefix of the device, from its model number or else from
+    # the characteristics it has, None if unknown.
+    if model_nr and model_nr[:4] in MODEL_CHARACTERISTICS:
+        return model_nr[:4]
+    for uuid, model in MODEL_SIGNATURES:
+        if uuid in uuids:
+            return model
+    return None
+
+
+def compile_read_plan(characteristics, model_nr=None, refresh_intervals=None, fields=None):
+    # Choose the fewest characteristics covering the requested fields, all
+    # the fields the characteristics provide by default. Each characteristic
+    # is read as often as the most frequently refreshed field it is chosen for.
+    refresh_intervals = refresh_intervals or {}
+    candidates = []
+    for characteristic in characteristics:
+        decoder = find_decoder(characteristic.uuid)
+        if decoder is not None:
+            candidates.append((characteristic, decoder))
+    uuids = set(str(characteristic.uuid).lower() for characteristic, _decoder in candidates)
+    model = detect_model(model_nr, uuids)
+    if model is not None:
+        wanted = set(str(uuid) for uuid in MODEL_CHARACTERISTICS[model][1])
+        if wanted & uuids:
+            candidates = [c for c in candidates if str(c[0].uuid).lower() in wanted]
+
+    available = set(field for _characteristic, decoder in candidates for field in decoder.fields)
+    uncovered = available if fields is None else available & set(fields)
+    chosen = {}
+    # Greedy set cover, the characteristic covering the most missing fields
+    # first. Optimal for the few characteristics of a device.
+    while uncovered:
+        index, covered = max(((i, uncovered.intersection(decoder.fields))
+                              for i, (_characteristic, decoder) in enumerate(candidates) if i not in chosen),
+                             key=lambda item: len(item[1]), default=(None, None))
+        if not covered:
+            break
+        chosen[index] = tuple(field for field in candidates[index][1].fields if field in covered)
+        uncovered -= covered
+
+    steps = []
+    for index in sorted(chosen):
+        characteristic, decoder = candidates[index]
+        # Fields without a refresh interval are read on every poll, so the
+        # command also carrying the illuminance is only sent at the battery
+        # interval when the illuminance has an interval too.
+        refresh_interval = min(refresh_intervals.get(field, 0) for field in chosen[index])
+        steps.append(ReadStep(characteristic, decoder, chosen[index], refresh_interval))
+    return ReadPlan(None if model is None else MODEL_CHARACTERISTICS[model][0], steps)
@@ -0,0 +1,129 @@
+"""Scheduling of the polls of the Airthings devices."""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import logging
+import time
+
+_LOGGER = logging.getLogger(__name__)
+
+# Change per minute above which a value is considered to be moving fast
+DEFAULT_FAST_RATES = {
+    "co2": 10.0,
+    "voc": 10.0,
+    "radon_1day_avg": 1.0,
+}
+
+
+class AdaptiveInterval:
+    # Poll interval of each device adapted to its readings: the interval is
+    # halved while the values in fast_rates change quickly or the values in
+    # levels cross one of their level boundaries, grows by half while all
+    # values are flat, and is doubled when the battery is low. The interval
+    # always stays within min_interval and max_interval.
+    def __init__(self, base_interval, min_interval, max_interval, fast_rates=None, levels=None,
+                 battery_level=None, low_battery=20):
+        self.base_interval = base_interval
+        self.min_interval = min(min_interval, base_interval)
+        self.max_interval = max(max_interval, base_interval)
+        self.fast_rates = DEFAULT_FAST_RATES if fast_rates is None else fast_rates
+        self.levels = levels or {}
+        # Function converting the battery value to a percentage
+        self.battery_level = battery_level
+        self.low_battery = low_battery
+        self._devices = {}
+
+    @property
+    def enabled(self):
+        return self.min_interval < self.max_interval
+
+    def interval(self, mac):
+        state = self._devices.get(mac)
+        return self.base_interval if state is None else state[0]
+
+    def _level(self, name, value):
+        return sum(1 for boundary in self.levels[name] if value > boundary)
+
+    def next_interval(self, mac, data, now=None):
+        # Interval until the next poll of the device after a reading
+        now = time.monotonic() if now is None else now
+        interval, last_values, last_time = self._devices.get(mac, (self.base_interval, None, None))
+        values = {name: data[name] for name in set(self.fast_rates) | set(self.levels)
+                  if isinstance(data.get(name), (int, float))}
+
+        if last_values is not None and now > last_time:
+            minutes = (now - last_time) / 60.0
+            fast = any(abs(values[name] - last_values[name]) / minutes >= rate
+                       for name, rate in self.fast_rates.items()
+                       if name in values and name in last_values)
+            crossed = any(self._level(name, values[name]) != self._level(name, last_values[name])
+                          for name in self.levels if name in values and name in last_values)
+            if fast or crossed:
+                interval = interval / 2.0
+            elif all(abs(values[name] - last_values[name]) / minutes < rate / 4.0
+                     for name, rate in self.fast_rates.items()
+                     if name in values and name in last_values):
+                interval = interval * 1.5
+
+        battery = data.get("battery")
+        if self.battery_level is not None and isinstance(battery, (int, float)) \
+                and self.battery_level(battery) < self.low_battery:
+            interval = max(interval, self.base_interval * 2)
+
+        interval = max(self.min_interval, min(self.max_interval, interval))
+        self._devices[mac] = (interval, values, now)
+        _LOGGER.debug("Next poll of %s in %.0fs", mac, interval)
+        return interval
+
+    def remove(self, mac):
+        self._devices.pop(mac, None)
+
+
+class StaggeredSlots:
+    # Spreads the polls of the devices over the poll interval: each device
+    # gets its own phase within the interval, evenly spaced in the order the
+    # devices were added, and polls are aligned to the device's phase. The
+    # phases are spaced again when devices are added or removed.
+    def __init__(self, epoch=None):
+        self.epoch = time.monotonic() if epoch is None else epoch
+        self._macs = []
+
+    def add(self, mac):
+        if mac not in self._macs:
+            self._macs.append(mac)
+
+    def remove(self, mac):
+        if mac in self._macs:
+            self._macs.remove(mac)
+
+    def phase(self, mac, interval):
+        if mac not in self._macs:
+            return 0.0
+        return interval * self._macs.index(mac) / len(self._macs)
+
+    def delay(self, mac, interval, now=None):
+        # Seconds until the next slot of the device, at least half an
+        # interval away so that moving to another slot never polls twice in
+        # a row.
+        now = time.monotonic() if now is None else now
+        earliest = now + interval / 2.0
+        offset = (earliest - self.epoch - self.phase(mac, interval)) % interval
+        slot = earliest if offset == 0 else earliest + interval - offset
+        return slot - now
@@ -12,16 +12,31 @@ tips
 For more details about this platform, please refer to the documentation at
 https://home-assistant.io/components/sensor.airthings_wave/
 """
+import asyncio
 import logging
-from datetime import timedelta
+import time
+from datetime import datetime, timedelta, timezone
 from math import exp
-import asyncio
 
+from .aggregator import Aggregator
 from .airthings import AirthingsWaveDetect
+from .cache import CACHE_VERSION, AirthingsDeviceCache
+from .capture import ReplayTransport
+from .connection import ConnectionPolicy
+from .history import ReadingHistory
+from .scheduler import AdaptiveInterval, StaggeredSlots
 
 import homeassistant.helpers.config_validation as cv
 import voluptuous as vol
 
+from homeassistant.core import callback
+from homeassistant.helpers.storage import Store
+from homeassistant.helpers.update_coordinator import (
+    CoordinatorEntity,
+    DataUpdateCoordinator,
+    UpdateFailed,
+)
+
 from homeassistant.components.sensor import (
     PLATFORM_SCHEMA,
     STATE_CLASS_MEASUREMENT,
@@ -40,6 +55,8 @@ from homeassistant.const import (ATTR_DEVICE_CLASS, ATTR_ICON, CONF_MAC,
                                  DEVICE_CLASS_BATTERY,
                                  ATTR_VOLTAGE,
                                  DEVICE_CLASS_VOLTAGE,
+                                 ENTITY_CATEGORY_DIAGNOSTIC,
+                                 TIME_MILLISECONDS,
                                  EVENT_HOMEASSISTANT_STOP, ILLUMINANCE,
                                  STATE_UNKNOWN)
 
@@ -49,6 +66,10 @@ SCAN_INTERVAL = timedelta(seconds=300)
 
 ATTR_DEVICE_DATE_TIME = 'device_date_time'
 ATTR_RADON_LEVEL = 'radon_level'
+ATTR_ROLLING_MIN = 'rolling_min'
+ATTR_ROLLING_MAX = 'rolling_max'
+ATTR_ROLLING_MEAN = 'rolling_mean'
+ATTR_TREND = 'trend_per_hour'
 DEVICE_CLASS_RADON='radon'
 DEVICE_CLASS_ACCELEROMETER='accelerometer'
 DEVICE_CLASS_CO2='co2'
@@ -90,6 +111,35 @@ DOMAIN = 'airthings'
 
 CONF_VOLTAGE_100 = "voltage_100"
 CONF_VOLTAGE_0 = "voltage_0"
+CONF_MAX_CONNECTIONS = "max_connections"
+CONF_EXPECTED_DEVICES = "expected_devices"
+CONF_CONTINUOUS_DISCOVERY = "continuous_discovery"
+CONF_KEEP_ALIVE = "keep_alive"
+CONF_REFRESH_INTERVALS = "refresh_intervals"
+CONF_MIN_SCAN_INTERVAL = "min_scan_interval"
+CONF_MAX_SCAN_INTERVAL = "max_scan_interval"
+CONF_DIAGNOSTICS = "diagnostics"
+CONF_HISTORY_SIZE = "history_size"
+CONF_HISTORY_WINDOW = "history_window"
+CONF_ADAPTERS = "adapters"
+CONF_CAPTURE_FILE = "capture_file"
+CONF_REPLAY_FILE = "replay_file"
+CONF_REPLAY_SPEED = "replay_speed"
+CONF_REPLAY_LOOP = "replay_loop"
+CONF_DEADBANDS = "deadbands"
+CONF_MAX_SILENCE = "max_silence"
+CONF_AGGREGATOR_HOST = "aggregator_host"
+CONF_AGGREGATOR_PORT = "aggregator_port"
+CONF_AGGREGATOR_TOKEN = "aggregator_token"
+CONF_FAILOVER_TIME = "failover_time"
+
+CACHE_STORAGE_KEY = "airthings_wave.devices"
+# Seconds after which an unchanged state is published again
+DEFAULT_MAX_SILENCE = 3600
+# Seconds before retrying to set up an unreachable device, doubled after
+# every failure up to the maximum.
+SETUP_RETRY_INTERVAL = 60
+MAX_SETUP_RETRY_INTERVAL = 3600
 
 PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_MAC, default=''): cv.string,
@@ -97,15 +147,46 @@ PLATFORM_SCHEMA = PLATFORM_SCHEMA.extend({
     vol.Optional(CONF_ELEVATION, default=0): vol.Any(vol.Coerce(float), None),
     vol.Optional(CONF_VOLTAGE_100, default=3.2): vol.Any(vol.Coerce(float), None),
     vol.Optional(CONF_VOLTAGE_0, default=2.2): vol.Any(vol.Coerce(float), None),
+    vol.Optional(CONF_MAX_CONNECTIONS, default=1): vol.All(vol.Coerce(int), vol.Range(min=1)),
+    vol.Optional(CONF_EXPECTED_DEVICES): vol.All(vol.Coerce(int), vol.Range(min=1)),
+    vol.Optional(CONF_CONTINUOUS_DISCOVERY, default=False): cv.boolean,
+    vol.Optional(CONF_KEEP_ALIVE, default=0): vol.All(vol.Coerce(int), vol.Range(min=0)),
+    vol.Optional(CONF_REFRESH_INTERVALS, default={}): {cv.string: cv.time_period},
+    vol.Optional(CONF_MIN_SCAN_INTERVAL): cv.time_period,
+    vol.Optional(CONF_MAX_SCAN_INTERVAL): cv.time_period,
+    vol.Optional(CONF_DIAGNOSTICS, default=False): cv.boolean,
+    vol.Optional(CONF_HISTORY_SIZE, default=0): vol.All(vol.Coerce(int), vol.Range(min=0)),
+    vol.Optional(CONF_HISTORY_WINDOW, default=timedelta(hours=24)): cv.time_period,
+    vol.Optional(CONF_ADAPTERS): vol.All(cv.ensure_list, [cv.string]),
+    vol.Optional(CONF_CAPTURE_FILE): cv.string,
+    vol.Optional(CONF_REPLAY_FILE): cv.string,
+    vol.Optional(CONF_REPLAY_SPEED, default=1.0): vol.All(vol.Coerce(float), vol.Range(min=0)),
+    vol.Optional(CONF_REPLAY_LOOP, default=True): cv.boolean,
+    vol.Optional(CONF_DEADBANDS, default={}): {cv.string: vol.Any(None, vol.Coerce(float))},
+    vol.Optional(CONF_MAX_SILENCE): cv.time_period,
+    vol.Optional(CONF_AGGREGATOR_HOST, default="0.0.0.0"): cv.string,
+    # The collectors must authenticate, anyone else on the network could
+    # create entities and push values into them.
+    vol.Inclusive(CONF_AGGREGATOR_PORT, "aggregator"): cv.port,
+    vol.Inclusive(CONF_AGGREGATOR_TOKEN, "aggregator"): cv.string,
+    vol.Optional(CONF_FAILOVER_TIME, default=timedelta(seconds=900)): cv.time_period,
 })
 
 
 class Sensor:
-    def __init__(self, unit, unit_scale, device_class, icon):
+    def __init__(self, unit, unit_scale, device_class, icon, refresh_interval=None, deadband=None,
+                 max_silence=DEFAULT_MAX_SILENCE):
         self.unit = unit
         self.unit_scale = unit_scale
         self.device_class = device_class
         self.icon = icon
+        # Minimum seconds between reads of the value, None to read it on every poll
+        self.refresh_interval = refresh_interval
+        # Smallest change of the value read from the device that is published,
+        # None to publish every change.
+        self.deadband = deadband
+        # Seconds after which the state is published even if unchanged
+        self.max_silence = max_silence
 
     def set_parameters(self, parameters):
         self.parameters = parameters
@@ -122,6 +203,31 @@ class Sensor:
     def get_extra_attributes(self, data):
         return {}
 
+    def should_publish(self, published, value, silence):
+        # Whether a new reading differs enough from the published one
+        if self.max_silence is not None and silence >= self.max_silence:
+            return True
+        if self.deadband is None or published is None or value is None:
+            return value != published
+        try:
+            return abs(value - published) >= self.deadband
+        except TypeError:
+            return value != published
+
+    def get_history_attributes(self, stats):
+        # Rolling statistics of the recent readings, see history.py
+        if stats is None:
+            return {}
+        attributes = {ATTR_ROLLING_MIN: round(self.transform(stats['min']), 2),
+                      ATTR_ROLLING_MAX: round(self.transform(stats['max']), 2),
+                      ATTR_ROLLING_MEAN: round(self.transform(stats['mean']), 2),
+                      ATTR_TREND: None}
+        if stats['trend'] is not None:
+            # A rate of change, only scaled
+            scale = 1.0 if self.unit_scale is None else self.unit_scale
+            attributes[ATTR_TREND] = round(stats['trend'] * scale, 2)
+        return attributes
+
 
 class PressureSensor(Sensor):
     def __init__(self, *args, **kwargs):
@@ -164,6 +270,9 @@ class BatterySensor(Sensor):
 
     def transform(self, value):
         self.voltage = value
+        return self.level(value)
+
+    def level(self, value):
         V_MAX=self.parameters[CONF_VOLTAGE_100] #3.2
         V_MIN=self.parameters[CONF_VOLTAGE_0] #2.4
         battery_level = max(0, min(100, round( (value-V_MIN)/(V_MAX-V_MIN)*100)))
@@ -172,22 +281,26 @@ class BatterySensor(Sensor):
     def get_extra_attributes(self, data):
         return {ATTR_VOLTAGE: self.voltage}
 
+    def get_history_attributes(self, stats):
+        # transform() keeps the voltage of the latest reading
+        return {}
+
 
 DEVICE_SENSOR_SPECIFICS = { "date_time":Sensor('time', None, None, None),
-                            "battery":BatterySensor(PERCENT, None, DEVICE_CLASS_BATTERY, 'mdi:battery'),
-                            "temperature":Sensor(TEMP_CELSIUS, None, DEVICE_CLASS_TEMPERATURE, None),
-                            "humidity": Sensor(PERCENT, None, DEVICE_CLASS_HUMIDITY, None),
-                            "rel_atm_pressure": PressureSensor(ATM_METRIC_UNITS, None, DEVICE_CLASS_PRESSURE, None),
-                            "co2": Sensor(CO2_METRIC_UNITS, None, DEVICE_CLASS_CO2, 'mdi:molecule-co2'),
-                            "voc": Sensor(VOC_METRIC_UNITS, None, DEVICE_CLASS_VOC, 'mdi:cloud'),
+                            "battery":BatterySensor(PERCENT, None, DEVICE_CLASS_BATTERY, 'mdi:battery', refresh_interval=86400, deadband=0.01),
+                            "temperature":Sensor(TEMP_CELSIUS, None, DEVICE_CLASS_TEMPERATURE, None, deadband=0.1),
+                            "humidity": Sensor(PERCENT, None, DEVICE_CLASS_HUMIDITY, None, deadband=0.5),
+                            "rel_atm_pressure": PressureSensor(ATM_METRIC_UNITS, None, DEVICE_CLASS_PRESSURE, None, deadband=0.2),
+                            "co2": Sensor(CO2_METRIC_UNITS, None, DEVICE_CLASS_CO2, 'mdi:molecule-co2', deadband=10),
+                            "voc": Sensor(VOC_METRIC_UNITS, None, DEVICE_CLASS_VOC, 'mdi:cloud', deadband=10),
                             "illuminance": Sensor(ILLUMINANCE_LUX, None, DEVICE_CLASS_ILLUMINANCE, None),
                             "accelerometer": Sensor(SPEED_METRIC_UNITS, None, DEVICE_CLASS_ACCELEROMETER, 'mdi:vibrate'),
                             "radon_1day_avg": RadonSensor(VOLUME_BECQUEREL, None, DEVICE_CLASS_RADON, 'mdi:radioactive'),
-                            "radon_longterm_avg": RadonSensor(VOLUME_BECQUEREL, None, DEVICE_CLASS_RADON, 'mdi:radioactive')
+                            "radon_longterm_avg": RadonSensor(VOLUME_BECQUEREL, None, DEVICE_CLASS_RADON, 'mdi:radioactive', refresh_interval=3600)
                            }
 
 
-def setup_platform(hass, config, add_entities, discovery_info=None):
+async def async_setup_platform(hass, config, async_add_entities, discovery_info=None):
     """Set up the Airthings sensor."""
     scan_interval = config.get(CONF_SCAN_INTERVAL).total_seconds()
     mac = config.get(CONF_MAC)
@@ -206,59 +319,318 @@ def setup_platform(hass, config, add_entities, discovery_info=None):
         DEVICE_SENSOR_SPECIFICS["radon_longterm_avg"].set_unit_scale(VOLUME_PICOCURIE, BQ_TO_PCI_MULTIPLIER)
 
 
-    _LOGGER.debug("Searching for Airthings sensors...")
-    airthingsdetect = AirthingsWaveDetect(scan_interval, mac)
-    try:
+    continuous_discovery = mac is None and config.get(CONF_CONTINUOUS_DISCOVERY)
+    diagnostics = config.get(CONF_DIAGNOSTICS)
+
+    radon_levels = [VERY_LOW[1], LOW[1], MODERATE[1]]
+    scheduler = AdaptiveInterval(
+        scan_interval,
+        config.get(CONF_MIN_SCAN_INTERVAL, config.get(CONF_SCAN_INTERVAL)).total_seconds(),
+        config.get(CONF_MAX_SCAN_INTERVAL, config.get(CONF_SCAN_INTERVAL)).total_seconds(),
+        levels={"radon_1day_avg": radon_levels, "radon_longterm_avg": radon_levels},
+        battery_level=DEVICE_SENSOR_SPECIFICS["battery"].level)
+    slots = StaggeredSlots()
+
+    refresh_intervals = {name: sensor.refresh_interval for name, sensor in DEVICE_SENSOR_SPECIFICS.items()
+                         if sensor.refresh_interval is not None}
+    for name, interval in config.get(CONF_REFRESH_INTERVALS).items():
+        if name not in DEVICE_SENSOR_SPECIFICS:
+            _LOGGER.warning("Ignoring refresh interval of unknown sensor %s", name)
+            continue
+        refresh_intervals[name] = interval.total_seconds()
+
+    for name, deadband in config.get(CONF_DEADBANDS).items():
+        if name not in DEVICE_SENSOR_SPECIFICS:
+            _LOGGER.warning("Ignoring deadband of unknown sensor %s", name)
+            continue
+        DEVICE_SENSOR_SPECIFICS[name].deadband = deadband
+    if config.get(CONF_MAX_SILENCE) is not None:
+        for sensor in DEVICE_SENSOR_SPECIFICS.values():
+            sensor.max_silence = config.get(CONF_MAX_SILENCE).total_seconds()
+
+    history = None
+    if config.get(CONF_HISTORY_SIZE) > 0:
+        history = ReadingHistory(config.get(CONF_HISTORY_SIZE),
+                                 config.get(CONF_HISTORY_WINDOW).total_seconds())
+
+    transport = None
+    if config.get(CONF_REPLAY_FILE) is not None:
+        # Reading the whole capture blocks, done in the executor
+        transport = await hass.async_add_executor_job(
+            ReplayTransport, hass.config.path(config.get(CONF_REPLAY_FILE)),
+            config.get(CONF_REPLAY_SPEED), config.get(CONF_REPLAY_LOOP))
+    capture = config.get(CONF_CAPTURE_FILE)
+
+    airthingsdetect = AirthingsWaveDetect(scan_interval, mac,
+                                          max_connections=config.get(CONF_MAX_CONNECTIONS),
+                                          cache=AirthingsStorageCache(hass),
+                                          connection_policy=ConnectionPolicy(timeout=CONNECT_TIMEOUT),
+                                          keep_alive=config.get(CONF_KEEP_ALIVE),
+                                          refresh_intervals=refresh_intervals,
+                                          history=history,
+                                          adapters=config.get(CONF_ADAPTERS),
+                                          transport=transport,
+                                          capture=None if capture is None else hass.config.path(capture))
+    if transport is not None and mac is None:
+        # The replayed devices are known without scanning
+        airthingsdetect.airthing_devices = sorted(transport.devices)
+
+    # Discovery and the setup of the devices run in the background, the
+    # entities of each device are added as soon as it has a first reading.
+    tasks = set()
+    # Devices with entities, polled here or by remote collectors
+    added = set()
+    # Devices being set up here
+    started = set()
+
+    def async_run(coro):
+        # Not tracked by hass, so Home Assistant does not wait for slow or
+        # unreachable devices before finishing its startup.
+        task = hass.loop.create_task(coro)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    async def async_add_device(mac):
+        # The aggregator and the entities use the upper case mac
+        if mac.upper() in added:
+            _LOGGER.info("Airthings device %s is read by a remote collector", mac)
+            return
+        delay = SETUP_RETRY_INTERVAL
+        while True:
+            try:
+                if await airthingsdetect.setup_device(mac):
+                    break
+            except Exception:
+                _LOGGER.exception("Failed to set up airthings device %s", mac)
+            _LOGGER.warning("Failed to set up airthings device %s, retrying in %.0fs", mac, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_SETUP_RETRY_INTERVAL)
+        _LOGGER.info("%s: %s", mac, airthingsdetect.devices.get(mac))
+        for sensor in airthingsdetect.sensors.get(mac, []):
+            _LOGGER.debug("%s: Found sensor UUID: %s Handle: %s", mac, sensor.uuid, sensor.handle)
+        if mac.upper() in added:
+            return
+        added.add(mac.upper())
+        slots.add(mac)
+        coordinator = AirthingsDataCoordinator(hass, airthingsdetect, mac, scheduler, slots)
+        async_add_entities(create_entities(airthingsdetect, mac, coordinator, diagnostics))
+
+    @callback
+    def async_device_discovered(mac):
+        _LOGGER.info("Setting up discovered airthings device %s", mac)
+        started.add(mac.upper())
+        async_run(async_add_device(mac))
+
+    async def async_retry(action, func):
+        # Run func until it does not raise, for example while the Bluetooth
+        # adapter is not powered yet at boot.
+        delay = SETUP_RETRY_INTERVAL
+        while True:
+            try:
+                return await func()
+            except Exception:
+                _LOGGER.exception("Failed to %s, retrying in %.0fs", action, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MAX_SETUP_RETRY_INTERVAL)
+
+    def async_start_devices():
+        for device_mac in list(airthingsdetect.airthing_devices):
+            if device_mac.upper() not in started:
+                started.add(device_mac.upper())
+                async_run(async_add_device(device_mac))
+
+    async def async_start():
+        num_devices_cached = await async_retry("load the airthings device cache", airthingsdetect.load_cache)
+        if mac is None and num_devices_cached > 0:
+            _LOGGER.info("Using %s cached airthings device(s)", num_devices_cached)
+        # The cached devices are set up while searching for new ones
+        async_start_devices()
         if mac is None:
-            num_devices_found = asyncio.run(airthingsdetect.find_devices())
-            _LOGGER.info("Found {} airthings device(s)".format(num_devices_found))
-
-        if mac is None and num_devices_found == 0:
-            _LOGGER.warning("No airthings devices found.")
+            delay = SETUP_RETRY_INTERVAL
+            while True:
+                _LOGGER.debug("Searching for Airthings sensors...")
+                try:
+                    num_devices_found = await airthingsdetect.find_devices(
+                        expected=config.get(CONF_EXPECTED_DEVICES))
+                except Exception:
+                    _LOGGER.exception("Failed to search for airthings devices")
+                else:
+                    _LOGGER.info("Found %s airthings device(s)", num_devices_found)
+                    if num_devices_found > 0 or continuous_discovery:
+                        break
+                    _LOGGER.warning("No airthings devices found")
+                _LOGGER.warning("Searching for airthings devices again in %.0fs", delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_SETUP_RETRY_INTERVAL)
+        async_start_devices()
+
+        if continuous_discovery:
+            await async_retry("start the discovery of airthings devices",
+                              lambda: airthingsdetect.start_discovery(async_device_discovered))
+
+    aggregator = None
+    if config.get(CONF_AGGREGATOR_PORT) is not None:
+        aggregator = Aggregator(config.get(CONF_AGGREGATOR_HOST), config.get(CONF_AGGREGATOR_PORT),
+                                failover_time=config.get(CONF_FAILOVER_TIME).total_seconds(),
+                                token=config.get(CONF_AGGREGATOR_TOKEN), history=history)
+        remote_coordinators = {}
+
+        @callback
+        def async_remote_reading(mac, reading):
+            coordinator = remote_coordinators.get(mac)
+            if coordinator is not None:
+                coordinator.async_set_updated_data(reading)
+            elif mac not in added:
+                _LOGGER.info("Adding airthings device %s read by collector %s", mac, aggregator.owners[mac])
+                added.add(mac)
+                coordinator = AirthingsRemoteCoordinator(hass, aggregator, mac)
+                remote_coordinators[mac] = coordinator
+                async_add_entities(create_entities(aggregator, mac, coordinator, diagnostics))
+
+        # A port already in use must not keep the local devices from
+        # being set up, the aggregator is started in the background too.
+        async_run(async_retry("start the aggregator of the remote collectors",
+                              lambda: aggregator.start(async_remote_reading)))
+
+    async def async_stop(event):
+        for task in list(tasks):
+            task.cancel()
+        if aggregator is not None:
+            await aggregator.stop()
+        await airthingsdetect.close()
+
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, async_stop)
+    async_run(async_start())
+
+
+def create_entities(device, mac, coordinator, diagnostics=False):
+    """Create the sensor entities of a device with data.
+
+    device is the AirthingsWaveDetect polling the device or the Aggregator
+    receiving its readings from collectors.
+    """
+    data = device.sensordata[mac]
+    coordinator.async_set_updated_data(data)
+    entities = []
+    for name, val in data.items():
+        _LOGGER.debug("%s: %s: %s", mac, name, val)
+        entities.append(AirthingsSensor(mac, name, coordinator, device.devices.get(mac),
+                                        DEVICE_SENSOR_SPECIFICS[name]))
+    if diagnostics:
+        metrics = device.metrics.device(mac)
+        for name in DIAGNOSTIC_SENSORS:
+            entities.append(AirthingsDiagnosticSensor(mac, name, coordinator, metrics))
+    return entities
+
+
+class AirthingsStorageCache(AirthingsDeviceCache):
+    """Device cache kept in the storage of Home Assistant."""
+
+    def __init__(self, hass):
+        """Initialize the cache."""
+        super().__init__(None)
+        self._store = Store(hass, CACHE_VERSION, CACHE_STORAGE_KEY)
+
+    async def async_load(self):
+        """Load the cached devices, an unreadable cache is ignored."""
+        try:
+            content = await self._store.async_load()
+        except Exception:
+            _LOGGER.warning("Not able to read the airthings device cache, ignoring it")
             return
-
-        _LOGGER.debug("Getting info about device(s)")
-        devices_info =  asyncio.run(airthingsdetect.get_info())
-        for mac, dev in devices_info.items():
-            _LOGGER.info("{}: {}".format(mac, dev))
-
-        _LOGGER.debug("Getting sensors")
-        devices_sensors = asyncio.run(airthingsdetect.get_sensors())
-        for mac, sensors in devices_sensors.items():
-            for sensor in sensors:
-                _LOGGER.debug("{}: Found sensor UUID: {} Handle: {}".format(mac, sensor.uuid, sensor.handle))
-
-        _LOGGER.debug("Get initial sensor data to populate HA entities")
-        ha_entities = []
-        sensordata =  asyncio.run(airthingsdetect.get_sensor_data())
-        for mac, data in sensordata.items():
-            for name, val in data.items():
-                _LOGGER.debug("{}: {}: {}".format(mac, name, val))
-                ha_entities.append(AirthingsSensor(mac, name, airthingsdetect, devices_info[mac],
-                                                   DEVICE_SENSOR_SPECIFICS[name]))
-    except:
-        _LOGGER.exception("Failed intial setup.")
-        return
-
-    add_entities(ha_entities, True)
-
-
-class AirthingsSensor(SensorEntity):
+        if content is not None:
+            self._entries = content.get("devices", {})
+            _LOGGER.debug("Loaded %s device(s) from cache", len(self._entries))
+
+    async def async_save(self):
+        """Save the cached devices if they changed."""
+        if self._dirty:
+            self._dirty = False
+            # Entries are replaced, never changed in place, a shallow copy is
+            # enough for the write in the executor.
+            await self._store.async_save({"devices": dict(self._entries)})
+
+
+class AirthingsDataCoordinator(DataUpdateCoordinator):
+    """Fetch the data of one Airthings device for all of its entities."""
+
+    def __init__(self, hass, device, mac, scheduler, slots):
+        """Initialize the coordinator."""
+        super().__init__(hass, _LOGGER, name='{}-{}'.format(DOMAIN, mac.upper()),
+                         update_interval=timedelta(seconds=scheduler.interval(mac)))
+        self.device = device
+        self.mac = mac
+        self.scheduler = scheduler
+        self.slots = slots
+
+    @callback
+    def async_set_updated_data(self, data):
+        """Set data received outside of a refresh and reschedule the next one."""
+        self._schedule_next(data)
+        super().async_set_updated_data(data)
+
+    def _schedule_next(self, data):
+        if self.scheduler.enabled:
+            interval = self.scheduler.next_interval(self.mac, data)
+        else:
+            interval = self.scheduler.base_interval
+        # Poll in the time slot of the device, spreading the connections of
+        # all devices over the interval
+        self.update_interval = timedelta(seconds=self.slots.delay(self.mac, interval))
+
+    async def _async_update_data(self):
+        """Read the device, the snapshot is pushed to all entities at once."""
+        data = await self.device.get_device_sensor_data(self.mac)
+        if data is None:
+            if self.device.out_of_rotation(self.mac):
+                # Give its time slot to the other devices until it answers
+                self.slots.remove(self.mac)
+                self.scheduler.remove(self.mac)
+            raise UpdateFailed("Failed to read data from {}".format(self.mac))
+        self.slots.add(self.mac)
+        self._schedule_next(data)
+        return data
+
+
+class AirthingsRemoteCoordinator(DataUpdateCoordinator):
+    """Hold the readings of a device pushed by remote collectors."""
+
+    def __init__(self, hass, aggregator, mac):
+        """Initialize the coordinator."""
+        super().__init__(hass, _LOGGER, name='{}-{}'.format(DOMAIN, mac.upper()),
+                         update_interval=timedelta(seconds=aggregator.failover_time))
+        self.device = aggregator
+        self.mac = mac
+
+    async def _async_update_data(self):
+        """Check that a collector still delivers readings of the device."""
+        if not self.device.is_fresh(self.mac):
+            raise UpdateFailed("No reading of {} from any collector".format(self.mac))
+        return self.device.sensordata[self.mac]
+
+
+class AirthingsSensor(CoordinatorEntity, SensorEntity):
 
     _attr_state_class = STATE_CLASS_MEASUREMENT
 
     """General Representation of an Airthings sensor."""
-    def __init__(self, mac, name, device, device_info, sensor_specifics):
+    def __init__(self, mac, name, coordinator, device_info, sensor_specifics):
         """Initialize a sensor."""
-        self.device = device
+        super().__init__(coordinator)
         self._mac = mac
         self._name = '{}-{}'.format(mac.upper(), name)
-        _LOGGER.debug("Added sensor entity {}".format(self._name))
+        _LOGGER.debug("Added sensor entity %s", self._name)
         self._sensor_name = name
 
         self._device_class = sensor_specifics.device_class
         self._state = STATE_UNKNOWN
         self._sensor_specifics = sensor_specifics
+        self._metrics = coordinator.device.metrics.device(mac)
+        self._update_state()
+        # Value and availability last written to Home Assistant
+        self._published_value = self.coordinator.data[self._sensor_name]
+        self._published_available = True
+        self._published_at = time.monotonic()
 
     @property
     def name(self):
@@ -293,17 +665,95 @@ class AirthingsSensor(SensorEntity):
     def extra_state_attributes(self):
         """Return the state attributes of the sensor."""
         attributes = self._sensor_specifics.get_extra_attributes(self._state)
-        try:
-            attributes[ATTR_DEVICE_DATE_TIME] = self.device.sensordata[self._mac]['date_time']
-        except KeyError:
-            _LOGGER.exception("No date time of sensor reading data available.")
+        attributes[ATTR_DEVICE_DATE_TIME] = self.coordinator.data.date_time
+        history = self.coordinator.device.history
+        if history is not None:
+            attributes.update(self._sensor_specifics.get_history_attributes(
+                history.stats(self._mac, self._sensor_name)))
         return attributes
 
-    def update(self):
-        """Fetch new state data for the sensor.
-        This is the only method that should fetch new data for Home Assistant.
-        """
-        asyncio.run(self.device.get_sensor_data())
-        value = self.device.sensordata[self._mac][self._sensor_name]
+    def _update_state(self):
+        value = self.coordinator.data[self._sensor_name]
         self._state = self._sensor_specifics.transform(value)
-        _LOGGER.debug("State {} {}".format(self._name, self._state))
+        _LOGGER.debug("State %s %s", self._name, self._state)
+
+    @callback
+    def _handle_coordinator_update(self):
+        """Handle a new snapshot of the device data from the coordinator."""
+        value = self.coordinator.data.get(self._sensor_name)
+        now = time.monotonic()
+        if (self.available == self._published_available and
+                not self._sensor_specifics.should_publish(self._published_value, value,
+                                                          now - self._published_at)):
+            self._metrics.suppressed_writes += 1
+            return
+        self._update_state()
+        self._published_value = value
+        self._published_available = self.available
+        self._published_at = now
+        self._metrics.state_writes += 1
+        self.async_write_ha_state()
+
+
+def _mean_ms(histogram):
+    return None if histogram.mean is None else round(histogram.mean * 1000.0, 1)
+
+
+def _last_success(metrics):
+    if metrics.last_success is None:
+        return None
+    return datetime.fromtimestamp(metrics.last_success, timezone.utc)
+
+
+# Name: (unit, device class, value of the DeviceMetrics of the device)
+DIAGNOSTIC_SENSORS = {
+    'connect_time': (TIME_MILLISECONDS, None, lambda m: _mean_ms(m.connect_time)),
+    'read_time': (TIME_MILLISECONDS, None, lambda m: _mean_ms(m.read_time)),
+    'retries': (None, None, lambda m: m.retries),
+    'timeouts': (None, None, lambda m: m.timeouts + m.command_timeouts),
+    'poll_failures': (None, None, lambda m: m.poll_failures),
+    'last_success': (None, DEVICE_CLASS_TIMESTAMP, _last_success),
+    'suppressed_writes': (None, None, lambda m: m.suppressed_writes),
+}
+
+
+class AirthingsDiagnosticSensor(CoordinatorEntity, SensorEntity):
+    """Polling statistics of an Airthings device."""
+
+    _attr_entity_category = ENTITY_CATEGORY_DIAGNOSTIC
+
+    def __init__(self, mac, name, coordinator, metrics):
+        """Initialize a diagnostic sensor."""
+        super().__init__(coordinator)
+        self._name = '{}-{}'.format(mac.upper(), name)
+        self._unit, self._device_class, self._value = DIAGNOSTIC_SENSORS[name]
+        self._metrics = metrics
+
+    @property
+    def name(self):
+        """Return the name of the sensor."""
+        return self._name
+
+    @property
+    def available(self):
+        """Return True, the statistics are also updated by failed polls."""
+        return True
+
+    @property
+    def native_value(self):
+        """Return the current value of the statistic."""
+        return self._value(self._metrics)
+
+    @property
+    def device_class(self):
+        """Return the device class of the sensor."""
+        return self._device_class
+
+    @property
+    def native_unit_of_measurement(self):
+        """Return the unit the value is expressed in."""
+        return self._unit
+
+    @property
+    def unique_id(self):
+        return self._name
@@ -0,0 +1,389 @@
+"""Simulated Bluetooth transport with virtual Airthings devices."""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import asyncio
+import logging
+import random
+import struct
+import time
+from collections import namedtuple
+from datetime import datetime
+
+from .decoders import (CHAR_UUID_DATETIME, CHAR_UUID_TEMPERATURE, CHAR_UUID_HUMIDITY,
+                       CHAR_UUID_RADON_1DAYAVG, CHAR_UUID_RADON_LONG_TERM_AVG,
+                       CHAR_UUID_ILLUMINANCE_ACCELEROMETER, CHAR_UUID_WAVE_PLUS_DATA,
+                       CHAR_UUID_WAVE_2_DATA, CHAR_UUID_WAVEMINI_DATA, COMMAND_UUID)
+from .mqtt import CONNACK, CONNECT, DISCONNECT, PINGREQ, PINGRESP, PUBLISH, MqttError, packet, read_packet
+
+_LOGGER = logging.getLogger(__name__)
+
+# Same values as the characteristics in airthings.py, not imported from
+# there to keep the simulator usable on its own.
+AIRTHINGS_MANUFACTURER_ID = 820
+CHAR_UUID_MANUFACTURER_NAME = '00002a29-0000-1000-8000-00805f9b34fb'
+CHAR_UUID_SERIAL_NUMBER_STRING = '00002a25-0000-1000-8000-00805f9b34fb'
+CHAR_UUID_MODEL_NUMBER_STRING = '00002a24-0000-1000-8000-00805f9b34fb'
+CHAR_UUID_DEVICE_NAME = '00002a00-0000-1000-8000-00805f9b34fb'
+CHAR_UUID_FIRMWARE_REV = '00002a26-0000-1000-8000-00805f9b34fb'
+CHAR_UUID_HARDWARE_REV = '00002a27-0000-1000-8000-00805f9b34fb'
+
+# Model number and sensor characteristics of each model
+MODELS = {
+    "wave": ("2900", [CHAR_UUID_DATETIME, CHAR_UUID_TEMPERATURE, CHAR_UUID_HUMIDITY,
+                      CHAR_UUID_RADON_1DAYAVG, CHAR_UUID_RADON_LONG_TERM_AVG,
+                      CHAR_UUID_ILLUMINANCE_ACCELEROMETER]),
+    "wave_mini": ("2920", [CHAR_UUID_WAVEMINI_DATA, COMMAND_UUID]),
+    "wave_plus": ("2930", [CHAR_UUID_WAVE_PLUS_DATA, COMMAND_UUID]),
+    "wave_2": ("2950", [CHAR_UUID_WAVE_2_DATA]),
+}
+
+SimulatedCharacteristic = namedtuple('SimulatedCharacteristic', ['uuid', 'handle'])
+SimulatedService = namedtuple('SimulatedService', ['uuid', 'characteristics'])
+SimulatedBLEDevice = namedtuple('SimulatedBLEDevice', ['address', 'name', 'rssi'])
+SimulatedAdvertisement = namedtuple('SimulatedAdvertisement', ['manufacturer_data'])
+
+
+class SimulatedBLEError(Exception):
+    pass
+
+
+class SimulatedDevice:
+    # A virtual Airthings device of the given model with slowly drifting readings
+    def __init__(self, mac, model, rng, firmware_rev="G-BLE-1.5.3-master+0"):
+        self.mac = mac
+        self.model = model
+        self.rng = rng
+        self.rssi = rng.randint(-95, -50)
+        self._adapter_rssi = {}
+        model_nr, sensor_uuids = MODELS[model]
+        self.info = {
+            CHAR_UUID_MANUFACTURER_NAME: "Airthings AS",
+            CHAR_UUID_SERIAL_NUMBER_STRING: mac.replace(":", "")[-10:],
+            CHAR_UUID_MODEL_NUMBER_STRING: model_nr,
+            CHAR_UUID_DEVICE_NAME: "Airthings {}".format(model),
+            CHAR_UUID_FIRMWARE_REV: firmware_rev,
+            CHAR_UUID_HARDWARE_REV: "REV A",
+        }
+        uuids = list(self.info) + [str(uuid) for uuid in sensor_uuids]
+        self.characteristics = [SimulatedCharacteristic(uuid, handle)
+                                for handle, uuid in enumerate(uuids, start=10)]
+        self.values = {"temperature": 21.5, "humidity": 45.0, "radon_1day_avg": 50,
+                       "radon_longterm_avg": 60, "rel_atm_pressure": 1004.0,
+                       "co2": 800, "voc": 120, "illuminance": 12, "battery": 2.95}
+
+    def rssi_on(self, adapter):
+        # Signal of the device as seen by the given adapter
+        if adapter not in self._adapter_rssi:
+            self._adapter_rssi[adapter] = self.rng.randint(-95, -50)
+        return self._adapter_rssi[adapter]
+
+    def advance(self):
+        for name, step in (("temperature", 0.1), ("humidity", 0.5), ("co2", 10), ("voc", 5)):
+            self.values[name] = max(0, self.values[name] + self.rng.uniform(-step, step))
+
+    def read(self, uuid):
+        uuid = str(uuid)
+        if uuid in self.info:
+            return bytearray(self.info[uuid].encode("utf-8"))
+        self.advance()
+        v = self.values
+        if uuid == str(CHAR_UUID_WAVE_PLUS_DATA):
+            return bytearray(struct.pack('<4B8H', 1, int(v["humidity"] * 2), 0, 0,
+                                         v["radon_1day_avg"], v["radon_longterm_avg"],
+                                         int(v["temperature"] * 100), int(v["rel_atm_pressure"] * 50),
+                                         int(v["co2"]), int(v["voc"]), 0, 0))
+        if uuid == str(CHAR_UUID_WAVE_2_DATA):
+            return bytearray(struct.pack('<4B8H', 1, int(v["humidity"] * 2), 0, 0,
+                                         v["radon_1day_avg"], v["radon_longterm_avg"],
+                                         int(v["temperature"] * 100), 0, 0, 0, 0, 0))
+        if uuid == str(CHAR_UUID_WAVEMINI_DATA):
+            return bytearray(struct.pack('<HHHHHHLL', 1, int((v["temperature"] + 273.15) * 100), 0,
+                                         int(v["humidity"] * 100), int(v["voc"]), 0, 0, 0))
+        if uuid == str(CHAR_UUID_DATETIME):
+            now = datetime.now()
+            return bytearray(struct.pack('<HBBBBB', now.year, now.month, now.day,
+                                         now.hour, now.minute, now.second))
+        if uuid == str(CHAR_UUID_TEMPERATURE):
+            return bytearray(struct.pack('<h', int(v["temperature"] * 100)))
+        if uuid == str(CHAR_UUID_HUMIDITY):
+            return bytearray(struct.pack('<H', int(v["humidity"] * 100)))
+        if uuid == str(CHAR_UUID_RADON_1DAYAVG):
+            return bytearray(struct.pack('<H', v["radon_1day_avg"]))
+        if uuid == str(CHAR_UUID_RADON_LONG_TERM_AVG):
+            return bytearray(struct.pack('<H', v["radon_longterm_avg"]))
+        if uuid == str(CHAR_UUID_ILLUMINANCE_ACCELEROMETER):
+            return bytearray(struct.pack('BB', v["illuminance"], 0))
+        raise SimulatedBLEError("Characteristic {} not readable on {}".format(uuid, self.mac))
+
+    def command(self, data):
+        # Response to a command written to the access control point
+        if bytes(data[0:1]) != b'\x6d':
+            return bytearray(data[0:1]) + bytearray(b'\x00')
+        values = [0] * 19
+        values[2] = self.values["illuminance"]
+        values[17] = int(self.values["battery"] * 1000)
+        return bytearray(data[0:1]) + bytearray(b'\x00') + bytearray(struct.pack('<L12B6H', *values))
+
+
+class SimulatedClient:
+    # Implements the parts of BleakClient used by AirthingsWaveDetect
+    def __init__(self, transport, address, disconnected_callback=None, adapter=None, **kwargs):
+        self.transport = transport
+        self.address = address
+        self.adapter = adapter or transport.adapters[0]
+        self.disconnected_callback = disconnected_callback
+        self.is_connected = False
+        self._notify_callbacks = {}
+        self._connected_at = None
+        self._reading = 0
+        self._read_lock = asyncio.Lock()
+
+    @property
+    def device(self):
+        return self.transport.devices.get(self.address.upper())
+
+    async def connect(self, **kwargs):
+        transport = self.transport
+        if self.adapter not in transport.adapter_connections:
+            raise SimulatedBLEError("No adapter {}".format(self.adapter))
+        await transport.delay(transport.connect_latency)
+        if self.device is None or transport.fails(self.adapter):
+            raise SimulatedBLEError("Device {} not found".format(self.address))
+        if transport.adapter_slots is not None and transport.adapter_connections[self.adapter] >= transport.adapter_slots:
+            raise SimulatedBLEError("No free connection slot on {}".format(self.adapter))
+        transport.adapter_connections[self.adapter] += 1
+        self.is_connected = True
+        self._connected_at = time.monotonic()
+        self.transport.connections += 1
+        self.transport.clients[self.address.upper()] = self
+        return True
+
+    async def disconnect(self):
+        self.drop()
+        return True
+
+    def drop(self):
+        # Connection closed by either side, the disconnected callback is
+        # called in both cases like with bleak.
+        if self.is_connected:
+            self.is_connected = False
+            self._notify_callbacks = {}
+            self.transport.adapter_connections[self.adapter] -= 1
+            self.transport.record_session(self.address.upper(), time.monotonic() - self._connected_at)
+            if self.disconnected_callback is not None:
+                self.disconnected_callback(self)
+
+    def _check_connected(self):
+        if not self.is_connected:
+            raise SimulatedBLEError("Not connected to {}".format(self.address))
+
+    async def get_services(self):
+        self._check_connected()
+        await self.transport.delay(self.transport.read_latency)
+        return [SimulatedService("b42e1c08-ade7-11e4-89d3-123b93f75cba", self.device.characteristics)]
+
+    async def read_gatt_char(self, char_specifier):
+        self._check_connected()
+        if self.transport.concurrent_reads == "reject" and self._reading:
+            raise SimulatedBLEError("Operation already in progress")
+        self._reading += 1
+        try:
+            if self.transport.concurrent_reads == "serialize":
+                async with self._read_lock:
+                    await self.transport.delay(self.transport.read_latency)
+            else:
+                await self.transport.delay(self.transport.read_latency)
+        finally:
+            self._reading -= 1
+        if self.transport.fails(self.adapter):
+            raise SimulatedBLEError("Read of {} failed".format(char_specifier))
+        self.transport.reads += 1
+        return self.device.read(getattr(char_specifier, "uuid", char_specifier))
+
+    async def write_gatt_char(self, char_specifier, data, response=False):
+        self._check_connected()
+        await self.transport.delay(self.transport.read_latency)
+        uuid = str(getattr(char_specifier, "uuid", char_specifier))
+        callback = self._notify_callbacks.get(uuid)
+        if callback is not None and uuid == str(COMMAND_UUID):
+            response_data = self.device.command(data)
+            asyncio.get_running_loop().call_later(
+                self.transport.scaled(self.transport.notification_delay), callback, uuid, response_data)
+
+    async def start_notify(self, char_specifier, callback, **kwargs):
+        self._check_connected()
+        await self.transport.delay(self.transport.read_latency)
+        self._notify_callbacks[str(getattr(char_specifier, "uuid", char_specifier))] = callback
+
+    async def stop_notify(self, char_specifier):
+        self._check_connected()
+        await self.transport.delay(self.transport.read_latency)
+        self._notify_callbacks.pop(str(getattr(char_specifier, "uuid", char_specifier)), None)
+
+
+class SimulatedScanner:
+    # Implements the parts of BleakScanner used by AirthingsWaveDetect, every
+    # device advertises once per advertisement_interval.
+    def __init__(self, transport, detection_callback, adapter=None, **kwargs):
+        self.transport = transport
+        self.detection_callback = detection_callback
+        self.adapter = adapter or transport.adapters[0]
+        self._task = None
+
+    async def _advertise(self):
+        while True:
+            for device in list(self.transport.devices.values()):
+                await asyncio.sleep(self.transport.scaled(self.transport.advertisement_interval)
+                                    / max(1, len(self.transport.devices)))
+                self.detection_callback(
+                    SimulatedBLEDevice(device.mac, "Airthings", device.rssi_on(self.adapter)),
+                    SimulatedAdvertisement({AIRTHINGS_MANUFACTURER_ID: b"\x00"}))
+
+    async def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._advertise())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+class SimulatedTransport:
+    # Drop-in replacement for BleakTransport, all latencies are in seconds
+    # and multiplied by time_scale. Each of the adapters accepts at most
+    # adapter_slots connections at a time, None for no limit. Concurrent
+    # reads on a connection overlap, are serialized or rejected depending on
+    # concurrent_reads ("overlap", "serialize" or "reject").
+    def __init__(self, connect_latency=0.0, read_latency=0.0, failure_rate=0.0,
+                 notification_delay=0.0, advertisement_interval=0.1, time_scale=1.0, seed=None,
+                 adapters=None, adapter_slots=None, concurrent_reads="overlap"):
+        self.connect_latency = connect_latency
+        self.read_latency = read_latency
+        self.failure_rate = failure_rate
+        self.notification_delay = notification_delay
+        self.advertisement_interval = advertisement_interval
+        self.time_scale = time_scale
+        self.rng = random.Random(seed)
+        self.adapters = list(adapters or ["hci0"])
+        self.adapter_slots = adapter_slots
+        self.concurrent_reads = concurrent_reads
+        self.adapter_connections = {name: 0 for name in self.adapters}
+        # Extra failure rate of degraded adapters
+        self.adapter_failure_rates = {}
+        self.devices = {}
+        self.clients = {}
+        self.connections = 0
+        self.reads = 0
+        self.sessions = {}
+
+    def add_device(self, model, mac=None):
+        if mac is None:
+            index = len(self.devices) + 1
+            mac = "A4:DA:22:{:02X}:{:02X}:{:02X}".format((index >> 16) & 0xFF, (index >> 8) & 0xFF, index & 0xFF)
+        device = SimulatedDevice(mac.upper(), model, self.rng)
+        self.devices[device.mac] = device
+        return device
+
+    def add_devices(self, count, models=None):
+        # Add count devices, cycling through the models
+        models = list(MODELS) if models is None else models
+        return [self.add_device(models[i % len(models)]) for i in range(count)]
+
+    def remove_device(self, mac):
+        self.drop_connection(mac)
+        self.devices.pop(mac.upper(), None)
+
+    def drop_connection(self, mac):
+        # Simulate the device closing the connection
+        client = self.clients.get(mac.upper())
+        if client is not None:
+            client.drop()
+
+    def scaled(self, seconds):
+        return seconds * self.time_scale
+
+    async def delay(self, latency):
+        # Latency with +/- 50% jitter
+        if latency > 0:
+            await asyncio.sleep(self.scaled(latency) * self.rng.uniform(0.5, 1.5))
+
+    def degrade_adapter(self, adapter, failure_rate=1.0):
+        self.adapter_failure_rates[adapter] = failure_rate
+
+    def fails(self, adapter=None):
+        failure_rate = self.failure_rate + self.adapter_failure_rates.get(adapter, 0.0)
+        return failure_rate > 0 and self.rng.random() < failure_rate
+
+    def record_session(self, mac, duration):
+        self.sessions.setdefault(mac, []).append(duration)
+
+    def client(self, mac, **kwargs):
+        return SimulatedClient(self, mac, **kwargs)
+
+    def scanner(self, detection_callback, **kwargs):
+        return SimulatedScanner(self, detection_callback, **kwargs)
+
+
+class SimulatedMqttBroker:
+    # Local stand-in of an MQTT broker for the MqttSink, accepts every
+    # client and records the QoS 0 messages published to it.
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.messages = []
+        self.retained = {}
+        self.clients = []
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                packet_type, flags, body = await read_packet(reader)
+                if packet_type == CONNECT:
+                    # Protocol name, level, flags and keepalive precede the client id
+                    offset = 2 + struct.unpack("!H", body[0:2])[0] + 4
+                    length = struct.unpack("!H", body[offset:offset + 2])[0]
+                    self.clients.append(body[offset + 2:offset + 2 + length].decode("utf-8"))
+                    writer.write(packet(CONNACK, b"\x00\x00"))
+                elif packet_type == PUBLISH:
+                    length = struct.unpack("!H", body[0:2])[0]
+                    topic = body[2:2 + length].decode("utf-8")
+                    payload = body[2 + length:]
+                    self.messages.append((topic, payload))
+                    if flags & 0x01:
+                        self.retained[topic] = payload
+                elif packet_type == PINGREQ:
+                    writer.write(packet(PINGRESP))
+                elif packet_type == DISCONNECT:
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError, MqttError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,35 @@
+"""Bluetooth transport used to talk to the Airthings devices."""
+# Copyright (c) 2021 Martin Tremblay, Mark McCans
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+class BleakTransport:
+    # Creates the clients and scanners used by AirthingsWaveDetect, replaced
+    # by the simulated transport to run without Bluetooth hardware. bleak is
+    # imported on first use, importing it needs a Bluetooth stack on Linux.
+    def client(self, mac, **kwargs):
+        from bleak import BleakClient
+
+        return BleakClient(mac, **kwargs)
+
+    def scanner(self, detection_callback, **kwargs):
+        from bleak import BleakScanner
+
+        return BleakScanner(detection_callback=detection_callback, **kwargs)